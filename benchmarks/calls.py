@@ -0,0 +1,90 @@
+'''
+Measures running time of the compiled sort from examples/correct/mergesort.hom
+on a list of pseudorandom Ints, which is dominated by calls of small functions.
+Needs the toolchain used by run.sh: gcc, nasm and ld.
+
+usage: python3 benchmarks/calls.py [length=100000] [runs=3]
+'''
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+SORTED_FUNCTIONS = ['half', 'merge', 'sort']
+
+MAIN = '''
+fun less_int(a: Int, b: Int) -> Bool {
+    ret __builtin_operator_less[Bool](a, b, Bool::True, Bool::False);
+}
+
+fun random_list(n: Int, seed: Int, xs: List[Int]) -> List[Int] {
+    ret fit __builtin_operator_eq[Bool](n, 0, Bool::True, Bool::False) {
+        True => xs,
+        False => random_list(n - 1, (seed * 1103515245 + 12345) % 2147483648, List[Int]::Cons(seed, xs))
+    };
+}
+
+fun is_sorted(xs: List[Int]) -> Bool {
+    ret fit xs {
+        Cons _ (Cons _ _) => fit less_int(xs.xs.x, xs.x) {
+            True => Bool::False,
+            False => is_sorted(xs.xs)
+        },
+        _ => Bool::True
+    };
+}
+
+fun main() {
+    let sorted = sort[Int](random_list(LENGTH, 42, List[Int]::Nil), less_int);
+    fit is_sorted(sorted) {
+        True => wrt "sorted\\n",
+        False => wrt "not sorted\\n"
+    };
+}
+'''
+
+
+def program(length):
+    text = open(os.path.join(ROOT, 'examples', 'correct', 'mergesort.hom')).read()
+    items = re.split(r'\n(?=(?:fun|dis) )', text)
+    dises = [item for item in items if item.startswith('dis ')]
+    funs = [item for item in items if re.match(r'fun (\w+)', item) and re.match(r'fun (\w+)', item).group(1) in SORTED_FUNCTIONS]
+    return '\n'.join(dises + funs + [MAIN.replace('LENGTH', str(length))])
+
+
+def build(directory, length):
+    source = os.path.join(directory, 'main.hom')
+    with open(source, 'w') as f:
+        f.write(program(length))
+    with open(os.path.join(directory, 'main.asm'), 'w') as f:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'src', 'main.py'), source, '--compile'], stdout=f, check=True)
+
+    def run(*command):
+        subprocess.run(command, cwd=directory, check=True)
+    run('gcc', '-o', 'libhomie.o', '-c', '-nostdlib', '-fno-stack-protector', os.path.join(ROOT, 'libhomie.c'))
+    run('nasm', '-f', 'elf64', '-o', 'main.o', 'main.asm')
+    run('ld', 'main.o', 'libhomie.o', '-o', 'program.out')
+    return os.path.join(directory, 'program.out')
+
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with tempfile.TemporaryDirectory() as directory:
+        executable = build(directory, length)
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            output = subprocess.run([executable], capture_output=True, text=True).stdout
+            times.append(time.perf_counter() - start)
+
+    print(f"sorting {length} Ints: {output.strip()}, best of {runs} runs {min(times):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
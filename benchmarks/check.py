@@ -0,0 +1,49 @@
+'''
+Compares the --check path, which typechecks without annotating expressions with types,
+with the --compile path on the synthetic program of benchmarks/passes.py.
+Lexing and parsing are shared by both paths and are timed once.
+
+usage: python3 benchmarks/check.py [copies=300]
+'''
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from lex import lex
+from parsing.parse import parse
+from tokens import Source
+from typechecking.typechecker import typecheck
+from ast_to_ll import to_ll
+from compiler import compile
+from passes import program
+
+
+def check(tree):
+    typecheck(tree, annotate_types=False)
+
+
+def full(tree):
+    ctx, _ = typecheck(tree)
+    compile(to_ll(tree, ctx))
+
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    source = Source('<benchmark>', program(copies))
+    print(f"{copies} copies, {len(source.text.splitlines())} lines")
+
+    start = time.perf_counter()
+    tree = parse(lex(source)).parsed
+    print(f"{'parse':<10}{time.perf_counter() - start:8.3f}s")
+
+    for name, run in [("check", check), ("compile", full)]:
+        start = time.perf_counter()
+        run(tree)
+        print(f"{name:<10}{time.perf_counter() - start:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+'''
+Measures assembly generation for functions made of deeply nested calls and fits,
+where code of every node ends up inside the code of all of its ancestors.
+
+usage: python3 benchmarks/codegen.py [depth=1000] [functions=20]
+'''
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from compiler import *
+
+
+def nested_calls(depth):
+    expr = IntValue(0)
+    for _ in range(depth):
+        expr = Call(FunName("f"), [expr, Deref(ArgAddress(0))])
+    return expr
+
+
+def nested_fits(depth):
+    expr = IntValue(0)
+    for i in range(depth):
+        expr = Fit(Deref(ArgAddress(0)), [
+            FitBranch(Pattern(1, [Pattern(0, []), None]), expr),
+            FitBranch(None, IntValue(i)),
+        ])
+    return expr
+
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    functions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20 * depth))
+
+    program = Program(
+        [Fun(f"calls_{i}", 1, 0, [Return(nested_calls(depth))]) for i in range(functions)]
+        + [Fun(f"fits_{i}", 1, 0, [Return(nested_fits(depth))]) for i in range(functions)]
+    )
+
+    start = time.perf_counter()
+    asm = compile(program)
+    elapsed = time.perf_counter() - start
+
+    print(f"{2 * functions} functions of depth {depth}, {asm.count('\n') + 1} lines in {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+'''
+Measures typechecking time of generated fit expressions.
+Branches match lists of digits element by element, nested up to the given depth,
+so with 3 digits and depth 5 every fit has hundreds of branches.
+Besides the exhaustive fit, there is one missing a branch
+and one with branches made redundant by the branches above them.
+
+usage: python3 benchmarks/exhaustiveness.py [digits=3] [depth=5]
+'''
+import os
+import sys
+import time
+from itertools import product
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from lex import lex
+from parsing.parse import parse
+from tokens import Source
+from typechecking.typechecker import typecheck
+
+
+def list_pattern(digits, tail):
+    pattern = tail
+    for digit in reversed(digits):
+        pattern = f"Cons D{digit} ({pattern})"
+    return pattern
+
+
+def branches(digits, depth):
+    for length in range(depth):
+        for sequence in product(range(digits), repeat=length):
+            yield list_pattern(sequence, "Nil")
+    for sequence in product(range(digits), repeat=depth):
+        yield list_pattern(sequence, "_")
+
+
+def fit_function(name, patterns):
+    body = ",\n".join(f"        {pattern} => {i}" for i, pattern in enumerate(patterns))
+    return f"fun {name}(x: List) -> Int {{\n    ret fit x {{\n{body}\n    }};\n}}\n"
+
+
+def program(digits, depth):
+    patterns = list(branches(digits, depth))
+    variants = ", ".join(f"D{digit}" for digit in range(digits))
+    return "\n".join([
+        f"dis Digit {{ {variants} }}",
+        "dis List { Nil, Cons(head: Digit, tail: List) }",
+        fit_function("exhaustive", patterns),
+        fit_function("missing", patterns[:-1]),
+        fit_function("redundant", patterns + patterns[::digits]),
+    ]), len(patterns)
+
+
+def main():
+    digits = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    text, branch_count = program(digits, depth)
+    tree = parse(lex(Source('<benchmark>', text))).parsed
+
+    start = time.perf_counter()
+    _, report = typecheck(tree)
+    elapsed = time.perf_counter() - start
+
+    print(f"3 fits of about {branch_count} branches, depth {depth} in {elapsed:.2f}s")
+    print(f"{len(report.errors)} errors, {len(report.warnings)} warnings")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+'''
+Measures lexer throughput in tokens/sec on the examples/correct corpus
+repeated up to the given size.
+
+usage: python3 benchmarks/lexer.py [megabytes=4]
+'''
+import os
+import sys
+import time
+from glob import glob
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from lex import lex
+from tokens import Source
+
+
+def corpus(megabytes):
+    files = sorted(glob(os.path.join(ROOT, 'examples', 'correct', '*.hom')))
+    chunk = '\n'.join(open(f).read() for f in files)
+    return chunk * (megabytes * 2**20 // len(chunk) + 1)
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    source = Source('<benchmark>', corpus(megabytes))
+
+    start = time.perf_counter()
+    tokens = lex(source)
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(source.text) / 2**20:.1f} MiB, {len(tokens)} tokens in {elapsed:.2f}s")
+    print(f"{len(tokens) / elapsed:,.0f} tokens/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+'''
+Measures parser time and memory allocated while parsing
+the examples/correct corpus repeated the given number of times.
+Memory is traced with tracemalloc, which slows parsing down,
+so time is measured in a separate untraced run.
+
+usage: python3 benchmarks/parser_allocations.py [repeats=1000]
+'''
+import os
+import sys
+import time
+import tracemalloc
+from glob import glob
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from lex import lex
+from parsing.parse import parse
+from tokens import Source
+
+
+def corpus(repeats):
+    files = sorted(glob(os.path.join(ROOT, 'examples', 'correct', '*.hom')))
+    return '\n'.join(open(f).read() for f in files) * repeats
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    source = Source('<benchmark>', corpus(repeats))
+    tokens = lex(source)
+
+    start = time.perf_counter()
+    parse(tokens)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = parse(tokens)
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    retained = snapshot.statistics('filename')
+    blocks = sum(stat.count for stat in retained)
+    size = sum(stat.size for stat in retained)
+
+    print(f"{len(tokens)} tokens, {result.status.name} in {elapsed:.2f}s ({len(tokens) / elapsed:,.0f} tokens/sec)")
+    print(f"peak traced memory: {peak / 2**20:.1f} MiB")
+    print(f"retained after parsing: {blocks:,} blocks, {size / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
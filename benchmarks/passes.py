@@ -0,0 +1,59 @@
+'''
+Measures time spent in each compiler pass on a synthetic program
+made of the given number of renamed copies of examples/correct/mergesort.hom functions.
+
+usage: python3 benchmarks/passes.py [copies=300]
+'''
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from lex import lex
+from parsing.parse import parse
+from tokens import Source
+from typechecking.typechecker import typecheck
+from ast_to_ll import to_ll
+from compiler import compile
+
+
+def program(copies):
+    text = open(os.path.join(ROOT, 'examples', 'correct', 'mergesort.hom')).read()
+    items = re.split(r'\n(?=(?:fun|dis) )', text)
+    dises = [item for item in items if not item.startswith('fun ')]
+    funs = [item for item in items if item.startswith('fun ')]
+    names = [re.match(r'fun (\w+)', fun).group(1) for fun in funs if not fun.startswith('fun main(')]
+    name_regex = re.compile(r'\b(' + '|'.join(names) + r')\b')
+
+    copied = []
+    for copy in range(copies):
+        for fun in funs:
+            if copy == 0 or not fun.startswith('fun main('):
+                copied.append(name_regex.sub(lambda match: f"{match.group()}_{copy}", fun))
+    return '\n'.join(dises + copied)
+
+
+def timed(name, run, *args):
+    start = time.perf_counter()
+    result = run(*args)
+    print(f"{name:<10}{time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    source = Source('<benchmark>', program(copies))
+    print(f"{copies} copies, {len(source.text.splitlines())} lines")
+
+    tokens = timed("lex", lex, source)
+    tree = timed("parse", parse, tokens).parsed
+    ctx, report = timed("typecheck", typecheck, tree)
+    ll = timed("to_ll", to_ll, tree, ctx)
+    timed("compile", compile, ll)
+
+
+if __name__ == "__main__":
+    main()
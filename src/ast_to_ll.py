@@ -2,14 +2,19 @@ from dataclasses import dataclass
 import tree
 import compiler
 import sys
-from typechecking.typechecker import TypingContext, DisDeclaration, DisTy
-import typechecking.typechecker as typechecker
+from typechecking.typechecker import TypingContext, DisDeclaration, DisTy, InstantiationCache
 
 @dataclass
 class LLContext:
     var_to_id: dict[str, int]
     arg_to_id: dict[str, int]
     enum_defs: dict[str, DisDeclaration]
+    instantiations: InstantiationCache
+
+
+@tree.node_dispatch
+def expr_to_ll(expr: tree.ExprNode, ctx: LLContext):
+    raise Exception(f"Unexpected tree node: {expr}")
 
 
 def to_ll(program: tree.ProgramNode, ctx: TypingContext):
@@ -23,6 +28,7 @@ def to_ll(program: tree.ProgramNode, ctx: TypingContext):
     return compiler.Program(ll)
 
 
+@expr_to_ll.register(tree.VarNode)
 def var_to_ll(var: tree.VarNode, ctx: LLContext):
     name = var.name.text
     if name in ctx.var_to_id:
@@ -41,12 +47,16 @@ def var_adress_to_ll(var: tree.VarNode, ctx: LLContext):
     else:
         raise Exception(f"Not addressable {var}")
 
+@expr_to_ll.register(tree.FunInstNode)
 def fun_inst_to_ll(fun_inst: tree.FunInstNode, ctx: LLContext):
     return compiler.FunName(fun_inst.name.text)
 
+@expr_to_ll.register(tree.CallNode)
 def call_to_ll(call: tree.CallNode, ctx: LLContext):
     args = [expr_to_ll(arg, ctx) for arg in call.arguments]
     fun = expr_to_ll(call.fun, ctx)
+    if isinstance(fun, compiler.FunName) and fun.name in compiler.INTRINSICS:
+        return compiler.Intrinsic(fun.name, args)
     return compiler.Call(fun, args)
 
 def member_address_to_ll(member: tree.MemberNode, ctx: LLContext):
@@ -55,14 +65,17 @@ def member_address_to_ll(member: tree.MemberNode, ctx: LLContext):
     arg_id = variant_def.arg_index(member.member_name.text)
     return compiler.MemberAddress(expr_to_ll(member.expr, ctx), arg_id)
 
+@expr_to_ll.register(tree.MemberNode)
 def member_to_ll(member: tree.MemberNode, ctx: LLContext):
     return compiler.Deref(member_address_to_ll(member, ctx))
 
+@expr_to_ll.register(tree.RetNode)
 def ret_to_ll(ret: tree.RetNode, ctx: LLContext):
     expr = compiler.Noop() if ret.expr is None else expr_to_ll(ret.expr, ctx)
     return compiler.Return(expr)
 
 
+@expr_to_ll.register(tree.LetNode)
 def let_to_ll(let: tree.LetNode, ctx: LLContext):
     var_id = ctx.var_to_id[let.name.text]
     return compiler.Let(var_id, expr_to_ll(let.value, ctx))
@@ -74,8 +87,8 @@ def pattern_to_ll(ty: DisTy, pattern: tree.Pattern | None, ctx: LLContext):
     enum_def = ctx.enum_defs[ty.name]
     variant_def = enum_def.get_variant(pattern.name.text)
     children = []
-    for (pattern_part, arg) in zip(pattern.args, variant_def.args):
-        arg_ty = typechecker.substitute(arg.ty, ty.generic_types)
+    arg_tys = ctx.instantiations.variant_arg_types(ty.name, variant_def, ty.generic_types)
+    for (pattern_part, arg_ty) in zip(pattern.args, arg_tys):
         if not isinstance(arg_ty, DisTy):
             children.append(None)
         else:
@@ -84,6 +97,7 @@ def pattern_to_ll(ty: DisTy, pattern: tree.Pattern | None, ctx: LLContext):
     return compiler.Pattern(variant_id, children)
 
 
+@expr_to_ll.register(tree.FitExprNode, tree.FitStatementNode)
 def fit_to_ll(fit: tree.FitExprNode | tree.FitStatementNode, ctx: LLContext):
     obj = expr_to_ll(fit.expr, ctx)
     children = [compiler.FitBranch (
@@ -92,6 +106,7 @@ def fit_to_ll(fit: tree.FitExprNode | tree.FitStatementNode, ctx: LLContext):
     ) for branch in fit.branches]
     return compiler.Fit(obj, children)
 
+@expr_to_ll.register(tree.DisConstructorNode)
 def enum_cons_to_ll(cons: tree.DisConstructorNode, ctx:LLContext):
     enum_def = ctx.enum_defs[cons.name.text]
     if enum_def.get_variant(cons.variant_name.text).get_arg_count() == 0:
@@ -99,38 +114,11 @@ def enum_cons_to_ll(cons: tree.DisConstructorNode, ctx:LLContext):
     else:
         return compiler.FunName(compiler.constructor_name(cons.name.text, enum_def.get_variant_id(cons.variant_name.text)))
 
+@expr_to_ll.register(tree.Write)
 def write_to_ll(write: tree.Write, ctx: LLContext):
     return compiler.Print(write.value)
 
-
-def expr_to_ll(expr: tree.ExprNode, ctx: LLContext):
-    if isinstance(expr, tree.VarNode):
-        return var_to_ll(expr, ctx)
-    elif isinstance(expr, tree.FunInstNode):
-        return fun_inst_to_ll(expr, ctx)
-    elif isinstance(expr, tree.CallNode):
-        return call_to_ll(expr, ctx)
-    elif isinstance(expr, tree.MemberNode):
-        return member_to_ll(expr, ctx)
-    elif isinstance(expr, tree.RetNode):
-        return ret_to_ll(expr, ctx)
-    elif isinstance(expr, tree.FitExprNode) or isinstance(expr, tree.FitStatementNode):
-        return fit_to_ll(expr, ctx)
-    elif isinstance(expr, tree.LetNode):
-        return let_to_ll(expr, ctx)
-    elif isinstance(expr, tree.DisConstructorNode):
-        return enum_cons_to_ll(expr, ctx)
-    elif isinstance(expr, tree.Write):
-        return write_to_ll(expr, ctx)
-    elif isinstance(expr, tree.ValueNode):
-        return value_to_ll(expr, ctx)
-    elif isinstance(expr, tree.AssignNode):
-        return assign_to_ll(expr, ctx)
-    elif isinstance(expr, tree.BlockNode):
-        return block_to_ll(expr, ctx)
-    else:
-        raise Exception(f"Unexpected tree node: {expr}")
-
+@expr_to_ll.register(tree.AssignNode)
 def assign_to_ll(assign: tree.AssignNode, ty_ctx: TypingContext):
     if isinstance(assign.var, tree.VarNode):
         lhs = var_adress_to_ll(assign.var, ty_ctx)
@@ -152,14 +140,18 @@ def fun_to_ll(fun: tree.FunNode, ty_ctx: TypingContext):
 
     arg_to_id = {arg.name.text: i for (i, arg) in enumerate(fun.args)}
 
-    ctx = LLContext(var_to_id, arg_to_id, ty_ctx.dises)
+    ctx = LLContext(var_to_id, arg_to_id, ty_ctx.dises, ty_ctx.instantiations)
     body = [expr_to_ll(expr, ctx) for expr in fun.body.statements]
-    return compiler.Fun(fun.name.text, local_var_count, body)
+    ll = compiler.Fun(fun.name.text, len(fun.args), local_var_count, body)
+    compiler.mark_tail_calls(ll, True)
+    return ll
 
 
+@expr_to_ll.register(tree.ValueNode)
 def value_to_ll(val: tree.ValueNode, ty_ctx: TypingContext):
     return compiler.IntValue(val.token.text)
 
 
+@expr_to_ll.register(tree.BlockNode)
 def block_to_ll(block: tree.BlockNode, ctx: LLContext):
     return compiler.Block([expr_to_ll(stmt, ctx) for stmt in block.statements])
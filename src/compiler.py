@@ -1,12 +1,12 @@
 from __future__ import annotations
 from typing import *
 
-from dataclasses import dataclass
+from dataclasses import dataclass, is_dataclass
 from enum import Enum, auto
 
 from typechecking.typechecker import get_builtins
 
-type Expr = Create | Fit | FunName | Call | VarAddress | ArgAddress | MemberAddress | Deref
+type Expr = Create | Fit | FunName | Call | Intrinsic | VarAddress | ArgAddress | MemberAddress | Deref
 
 type Statement = Let | Return
 
@@ -15,7 +15,7 @@ class Noop:
     def pretty_print(self, depth):
         return ""
     def to_asm(self, ctx):
-        return ""
+        pass
 
 @dataclass
 class Block:
@@ -28,7 +28,8 @@ class Block:
         return "{" + "\n" + stmts + "\n" + " " * indent + "}"
 
     def to_asm(self, ctx: AsmContext):
-        return "\n".join(s.to_asm(ctx) for s in self.statements)
+        for s in self.statements:
+            s.to_asm(ctx)
 
 @dataclass
 class IntValue:
@@ -38,129 +39,225 @@ class IntValue:
     value: int
 
     def to_asm(self, ctx: AsmContext):
-        return f"mov rax, {self.value}"
+        ctx.emit(f"mov rax, {self.value}")
 
     def pretty_print(self, indent=1):
         return f"{self.value}"
 
 @dataclass
 class FitBranch:
-    """checks if object on stack fits the pattern and if so, leaves content's result in rax"""
+    """pattern None matches every object"""
     pattern: Pattern | None
     content: Expr
 
-    def to_asm(self, ctx: AsmContext, fit_end: str):
-        branch_end = ctx.unique_id("branch_end")
-        if self.pattern is None:
-            return f"""
-                {self.content.to_asm(ctx)}
-                jmp {fit_end}
-            """
-        else:
-            return f"""
-                mov rax, [rsp]
-                {self.pattern.to_asm(ctx)}
-                jnz {branch_end}
-                {self.content.to_asm(ctx)}
-                jmp {fit_end}
-                {branch_end}:
-            """
-
     def pretty_print(self, depth = 0) -> str:
         return f"{"_" if self.pattern is None else self.pattern.pretty_print()} => {self.content.pretty_print(depth + 1)}"
 
+# Fits dispatching on at least this many variants jump through a table instead of comparing the variant with each
+JUMP_TABLE_MIN_VARIANTS = 4
+
 @dataclass
 class Fit:
-    """leaves result in rax"""
+    """
+    leaves result in rax.
+    Patterns of branches are compiled to a decision tree, see DecisionTree,
+    so every object nested in the matched one is tested at most once. Contents of branches are shared by its leaves.
+    The matched object is pushed above a slot for every object with tested children, which holds it once tested.
+    """
     obj: Expr
     branches: List[FitBranch]
 
     def to_asm(self, ctx: AsmContext):
         fit_end = ctx.unique_id("fit_end")
-        return f"""
-            {self.obj.to_asm(ctx)}
-            push rax
-            {'\n'.join(branch.to_asm(ctx, fit_end) for branch in self.branches)}
-            {fit_end}:
-            add rsp, 8
-        """
+        self.obj.to_asm(ctx)
+        parents = sorted({parent for branch in self.branches if branch.pattern is not None for parent in parent_occurrences(branch.pattern)})
+        slots = {occurrence: 8 * i for i, occurrence in enumerate(reversed(parents))}
+        ctx.emit("push rax")
+        if len(slots) > 1:
+            ctx.emit(f"sub rsp, {8 * (len(slots) - 1)}")
+
+        bodies = [ctx.unique_id("fit_branch") for _ in self.branches]
+        tree = DecisionTree(ctx, bodies, fit_end, slots)
+        root = tree.label([((branch.pattern,), i) for i, branch in enumerate(self.branches)], ((),))
+        if not tree.pending:
+            ctx.emit(f"jmp {root}")
+        tree.to_asm()
+
+        for i, (branch, body) in enumerate(zip(self.branches, bodies)):
+            ctx.emit(f"{body}:")
+            branch.content.to_asm(ctx)
+            if i != len(self.branches) - 1:
+                ctx.emit(f"jmp {fit_end}")
+        ctx.emit(f"{fit_end}:", f"add rsp, {8 * max(len(slots), 1)}")
 
     def pretty_print(self, depth = 0) -> str:
         return f"fit {self.obj.pretty_print(depth + 1)} {{{br(depth)}{br(depth).join(b.pretty_print(depth + 1) + "," for b in self.branches)} {br(depth - 1)}}}"
 
+# Rows of a pattern matrix hold patterns of a branch for the tested objects, and the index of the branch
+type PatternRow = Tuple[Tuple[Pattern | None, ...], int]
 
+# Tested objects are reached from the matched object, which is on the stack, through children with these indices
+type Occurrence = Tuple[int, ...]
 
+def parent_occurrences(pattern: Pattern, occurrence: Occurrence = ()) -> Iterator[Occurrence]:
+    """occurrences of objects whose children are tested by the pattern, the matched object is always one"""
+    yield occurrence
+    for i, child in enumerate(pattern.children):
+        if child is not None and any(grandchild is not None for grandchild in child.children):
+            yield from parent_occurrences(child, occurrence + (i,))
 
-@dataclass
+class DecisionTree:
+    """
+    Decision tree of a fit, compiled from the matrix of patterns of its branches.
+    A node dispatches on the variant of the first object tested by the first row, either through a jump table
+    or by comparisons, to the node for rows fitting that variant, where children of the object are tested instead,
+    or to the node for rows matching every object there. The first row matching every object picks its branch.
+    Nodes are emitted once for every distinct matrix.
+    A node loads the tested object from its parent, which the node testing the parent stored in its slot,
+    so testing an object costs the same at every depth.
+    """
+    def __init__(self, ctx: AsmContext, bodies: List[str], no_match: str, slots: Dict[Occurrence, int]):
+        self.ctx = ctx
+        self.bodies = bodies
+        self.no_match = no_match
+        self.slots = slots
+        self.labels = {}
+        self.pending = []
+
+    def label(self, rows: List[PatternRow], occurrences: Tuple[Occurrence, ...]) -> str:
+        """label of code matching rows, new nodes are emitted by to_asm"""
+        if not rows:
+            return self.no_match
+        patterns, branch = rows[0]
+        if patterns.count(None) == len(patterns):
+            return self.bodies[branch]
+
+        key = (tuple(rows), occurrences)
+        if key not in self.labels:
+            self.labels[key] = self.ctx.unique_id("fit_node")
+            self.pending.append((self.labels[key], rows, occurrences))
+        return self.labels[key]
+
+    def to_asm(self):
+        while self.pending:
+            self.node_to_asm(*self.pending.pop())
+
+    def node_to_asm(self, label: str, rows: List[PatternRow], occurrences: Tuple[Occurrence, ...]):
+        ctx = self.ctx
+        column = next(i for i, pattern in enumerate(rows[0][0]) if pattern is not None)
+        arities = {}
+        for patterns, _ in rows:
+            if patterns[column] is not None:
+                variant = patterns[column].type_id
+                arities[variant] = max(arities.get(variant, 0), len(patterns[column].children))
+
+        cases = {variant: self.label(*self.specialize(rows, occurrences, column, variant, arity)) for variant, arity in sorted(arities.items())}
+        default = self.label(
+            [(patterns[:column] + patterns[column + 1:], branch) for patterns, branch in rows if patterns[column] is None],
+            occurrences[:column] + occurrences[column + 1:],
+        )
+
+        occurrence = occurrences[column]
+        ctx.emit(f"{label}:")
+        if occurrence:
+            ctx.emit(f"mov rax, {self.slot(occurrence[:-1])}")
+            emit_addr_from_rax(ctx)
+            ctx.emit(f"mov rax, [rax + {8 * occurrence[-1]}]")
+            if occurrence in self.slots:
+                ctx.emit(f"mov {self.slot(occurrence)}, rax")
+        else:
+            ctx.emit(f"mov rax, {self.slot(occurrence)}")
+        emit_variant_from_rax(ctx)
+
+        if len(cases) >= JUMP_TABLE_MIN_VARIANTS:
+            table = ctx.unique_id("fit_table")
+            labels = [cases.get(variant, default) for variant in range(max(cases) + 1)]
+            ctx.emit(
+                f"cmp rax, {len(labels)}",
+                f"jae {default}",
+                f"jmp qword [{table} + rax * 8]",
+                f"{table}:",
+                f"dq {', '.join(labels)}",
+            )
+        else:
+            for variant, case in cases.items():
+                ctx.emit(f"cmp rax, {variant}", f"je {case}")
+            ctx.emit(f"jmp {default}")
+
+    def slot(self, occurrence: Occurrence) -> str:
+        offset = self.slots[occurrence]
+        return f"[rsp + {offset}]" if offset else "[rsp]"
+
+    def specialize(self, rows: List[PatternRow], occurrences: Tuple[Occurrence, ...], column: int, variant: int, arity: int):
+        """rows fitting objects of the variant in the column, with the column replaced by children of the object"""
+        specialized = []
+        for patterns, branch in rows:
+            pattern = patterns[column]
+            if pattern is None:
+                children = (None,) * arity
+            elif pattern.type_id == variant:
+                children = tuple(pattern.children) + (None,) * (arity - len(pattern.children))
+            else:
+                continue
+            specialized.append((patterns[:column] + children + patterns[column + 1:], branch))
+        children = tuple(occurrences[column] + (i,) for i in range(arity))
+        return specialized, occurrences[:column] + children + occurrences[column + 1:]
+
+
+# patterns are compared by identity, so that rows of pattern matrices can be hashed
+@dataclass(eq=False)
 class Pattern:
-    """takes object in rax, destroys it. iff pattern matches object ZF is set"""
+    """matches objects of the variant whose children match the children patterns, None matches every object"""
     type_id: int
     children: List[Pattern | None]
 
-    def to_asm(self, ctx: AsmContext) -> str:
-        match_start = ctx.unique_id("match")
-        match_end = ctx.unique_id("match_end")
-        after_match_end = ctx.unique_id("after_match_end")
-
-        inner_match = ""
-        gap = 0
-
-        for child in self.children:
-            if child is None:
-                gap += 8
-            else:
-                inner_match += f"""
-                    add qword [rsp], {gap}
-                    mov rax, [rsp]
-                    mov rax, [rax]
-                    {child.to_asm(ctx)}
-                    jnz {match_end}
-                """
-                gap = 8
-
-        if inner_match == "":
-            return f"""
-                {get_variant_from_rax()}
-                cmp rax, {self.type_id}
-            """
-
-        return f"""
-            {match_start}:
-                mov rbx, rax
-                {get_variant_from_rax()}
-                cmp rax, {self.type_id}
-                jne {after_match_end}
-                mov rax, rbx
-                {get_addr_from_rax()}
-                push rax
-                {inner_match}
-            {match_end}:
-                pop rax
-            {after_match_end}:
-        """
     def pretty_print(self, depth = 0) -> str:
         return ' '.join([f"<{self.type_id}>"] + ['_' if c is None else c.pretty_print(depth + 1) for c in self.children])
 
 def br(depth):
     return "\n" + (depth + 1) * " "
 
+# Registers holding first arguments of direct calls.
+# Intrinsics, fits and assignments leave them intact, so functions can keep arguments in them.
+ARG_REGISTERS = ["rdi", "rsi", "r8", "r9", "r10", "r11"]
+
+def direct_label(name: str) -> str:
+    return f"{name}.direct"
+
 @dataclass
 class Fun:
+    """
+    The function label takes arguments on the stack with their address in rdi,
+    as for calls of function values, and the direct label takes them in ARG_REGISTERS.
+    Functions with more arguments than there are registers have no direct label.
+    Arguments stay in registers if the body keeps them there, see keeps_args_in_registers,
+    otherwise they are copied to the frame below local variables.
+    """
     name: str
+    args: int
     local_vars: int
     content: List[Statement]
 
-    def to_asm(self, ctx: AsmContext) -> str:
+    def to_asm(self, ctx: AsmContext):
         ctx.return_token = ctx.unique_id(f"{self.name}_ret")
         ctx.var_count = self.local_vars
-        return f"""
-            {self.name}:
-            mov rbp, rsp
-            sub rsp, {self.local_vars * 8}
-            {'\n'.join(s.to_asm(ctx) for s in self.content)}
-            mov rsp, rbp
-            ret
-        """
+        ctx.args_in_registers = self.args <= len(ARG_REGISTERS) and all(keeps_args_in_registers(s, ctx) for s in self.content)
+        frame = f"sub rsp, {(self.local_vars + (0 if ctx.args_in_registers else self.args)) * 8}"
+
+        if self.args <= len(ARG_REGISTERS):
+            registers = list(enumerate(ARG_REGISTERS[:self.args]))
+            ctx.emit(f"{self.name}:", *(f"mov {register}, [rdi + {8 * i}]" for i, register in reversed(registers)))
+            ctx.emit(f"{direct_label(self.name)}:", "push rbp", "mov rbp, rsp", frame)
+            if not ctx.args_in_registers:
+                ctx.emit(*(f"mov {ArgAddress(i).operand(ctx)}, {register}" for i, register in registers))
+        else:
+            ctx.emit(f"{self.name}:", "push rbp", "mov rbp, rsp", frame)
+            for i in range(self.args):
+                ctx.emit(f"mov rax, [rdi + {8 * i}]", f"mov {ArgAddress(i).operand(ctx)}, rax")
+
+        for s in self.content:
+            s.to_asm(ctx)
+        ctx.emit("mov rsp, rbp", "pop rbp", "ret")
 
     def pretty_print(self, depth = 0) -> str:
         return f"fun {self.name}[{self.local_vars}] {{{br(depth)}{br(depth).join(s.pretty_print(depth + 1) + ";" for s in self.content)}\n}}"
@@ -170,49 +267,112 @@ class Fun:
 class Return:
     content: Expr
 
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            {self.content.to_asm(ctx)}
-            mov rsp, rbp
-            ret
-        """
+    def to_asm(self, ctx: AsmContext):
+        self.content.to_asm(ctx)
+        ctx.emit("mov rsp, rbp", "pop rbp", "ret")
 
     def pretty_print(self, depth = 0) -> str:
         return f"ret {self.content.pretty_print(depth + 1)}"
 
 @dataclass
 class Call:
-    """calls function and leaves result in rax"""
+    """
+    calls function and leaves result in rax.
+    tail calls of direct functions leave the frame and jump to the function instead,
+    so the function returns its result straight to the caller
+    """
     function: Expr
     args: List[Expr]
+    tail: bool = False
 
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            push rbp
-            {'\n'.join(f'''
-                {arg.to_asm(ctx)}
-                push rax
-            ''' for arg in reversed(self.args))}
-            {self.function.to_asm(ctx)}
-            mov rdi, rsp
-            call rax
-            add rsp, {len(self.args) * 8}
-            pop rbp
+    def is_direct(self, ctx: AsmContext) -> bool:
+        return isinstance(self.function, FunName) and ctx.direct_functions.get(self.function.name) == len(self.args)
+
+    def to_asm(self, ctx: AsmContext):
+        if self.is_direct(ctx):
+            self.direct_call_to_asm(ctx)
+            return
+
+        ctx.emit("push rbp")
+        for arg in reversed(self.args):
+            arg.to_asm(ctx)
+            ctx.emit("push rax")
+        self.function.to_asm(ctx)
+        ctx.emit("mov rdi, rsp", "call rax", f"add rsp, {len(self.args) * 8}", "pop rbp")
+
+    def direct_call_to_asm(self, ctx: AsmContext):
         """
+        Arguments are evaluated last to first and popped to registers,
+        except for the first argument, which is still in rax.
+        Constants and variables are loaded to registers at the end instead,
+        variables only if no argument evaluated after them is non-trivial, that is neither a constant nor a variable,
+        and arguments kept in registers only if their register is not overwritten by then.
+        """
+        operands = [register_operand(arg, ctx) for arg in self.args]
+        late = [
+            operand is not None and (isinstance(arg, IntValue) or None not in operands[:i])
+            and (operand == ARG_REGISTERS[i] or operand not in ARG_REGISTERS[:len(self.args)])
+            for i, (arg, operand) in enumerate(zip(self.args, operands))
+        ]
+
+        evaluated = [i for i in reversed(range(len(self.args))) if not late[i]]
+        for i in evaluated:
+            self.args[i].to_asm(ctx)
+            if i != evaluated[-1]:
+                ctx.emit("push rax")
+        if evaluated:
+            ctx.emit(f"mov {ARG_REGISTERS[evaluated[-1]]}, rax")
+            ctx.emit(*(f"pop {ARG_REGISTERS[i]}" for i in reversed(evaluated[:-1])))
+        ctx.emit(*(
+            f"mov {register}, {operand}"
+            for register, operand, is_late in zip(ARG_REGISTERS, operands, late)
+            if is_late and register != operand
+        ))
+        if self.tail:
+            ctx.emit("mov rsp, rbp", "pop rbp", f"jmp {direct_label(self.function.name)}")
+        else:
+            ctx.emit(f"call {direct_label(self.function.name)}")
 
     def pretty_print(self, depth = 0) -> str:
         return f"({self.function.pretty_print(depth + 1)} {' '.join(arg.pretty_print(depth + 1) for arg in self.args)})"
 
+# Builtins computed inline, with the first argument in rax and the second in rcx.
+# Further arguments are left on the stack in order.
+INTRINSICS = {
+    '__builtin_operator_add': ["add rax, rcx"],
+    '__builtin_operator_sub': ["sub rax, rcx"],
+    '__builtin_operator_mul': ["imul rax, rcx"],
+    '__builtin_operator_div': ["cqo", "idiv rcx"],
+    '__builtin_operator_mod': ["cqo", "idiv rcx", "mov rax, rdx"],
+    '__builtin_operator_eq': ["cmp rax, rcx", "pop rax", "pop rcx", "cmovne rax, rcx"],
+    '__builtin_operator_less': ["cmp rax, rcx", "pop rax", "pop rcx", "cmovge rax, rcx"],
+}
+
+@dataclass
+class Intrinsic:
+    """computes builtin without calling it and leaves result in rax"""
+    name: str
+    args: List[Expr]
+
+    def to_asm(self, ctx: AsmContext):
+        # arguments are evaluated last to first, like arguments of calls
+        for arg in reversed(self.args[1:]):
+            arg.to_asm(ctx)
+            ctx.emit("push rax")
+        self.args[0].to_asm(ctx)
+        ctx.emit("pop rcx", *INTRINSICS[self.name])
+
+    def pretty_print(self, depth = 0) -> str:
+        return f"({self.name} {' '.join(arg.pretty_print(depth + 1) for arg in self.args)})"
+
 @dataclass
 class Let:
     var: int
     value: Expr
 
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            {self.value.to_asm(ctx)}
-            mov [rbp - {8 + 8 * self.var}], rax
-        """
+    def to_asm(self, ctx: AsmContext):
+        self.value.to_asm(ctx)
+        ctx.emit(f"mov [rbp - {8 + 8 * self.var}], rax")
 
     def pretty_print(self, depth = 0) -> str:
         return f"let ({self.var}) = {self.value.pretty_print(depth + 1)}"
@@ -220,29 +380,27 @@ class Let:
 @dataclass
 class FunName:
     name: str
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            mov rax, {self.name}
-        """
+    def to_asm(self, ctx: AsmContext):
+        ctx.emit(f"mov rax, {self.name}")
     def pretty_print(self, depth = 0) -> str:
         return self.name
 
 @dataclass
 class Program:
     functions: List[Fun]
-    def to_asm(self, ctx: AsmContext) -> str:
-        result = f"""
-            section .text
-            global main
-            extern _make_obj0
-            extern _make_obj1
-            extern _make_obj3
-            extern _make_obj7
-            {'\n'.join(f'extern {name}' for name in get_builtins().keys())}
-
-            {'\n'.join(f.to_asm(ctx) for f in self.functions)}
-        """
-        return '\n'.join(l for l in (l.strip() for l in result.split('\n')) if l != '')
+    def to_asm(self, ctx: AsmContext):
+        ctx.direct_functions = {f.name: f.args for f in self.functions if f.args <= len(ARG_REGISTERS)}
+        ctx.emit(
+            "section .text",
+            "global main",
+            "extern _make_obj0",
+            "extern _make_obj1",
+            "extern _make_obj3",
+            "extern _make_obj7",
+        )
+        ctx.emit(*(f"extern {name}" for name in get_builtins().keys()))
+        for f in self.functions:
+            f.to_asm(ctx)
 
     def pretty_print(self) -> str:
         return '\n\n'.join(f.pretty_print(0) for f in self.functions)
@@ -250,20 +408,22 @@ class Program:
 @dataclass
 class ArgAddress:
     i: int
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            lea rax, [rbp + {8 + 8 * self.i}]
-        """
+    def operand(self, ctx: AsmContext) -> str:
+        if ctx.args_in_registers:
+            return ARG_REGISTERS[self.i]
+        return f"[rbp - {8 + 8 * (ctx.var_count + self.i)}]"
+    def to_asm(self, ctx: AsmContext):
+        ctx.emit(f"lea rax, {self.operand(ctx)}")
     def pretty_print(self, depth = 0) -> str:
         return f"&[{self.i}]"
 
 @dataclass
 class VarAddress:
     var: int
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            lea rax, [rbp - {8 + 8 * self.var}]
-        """
+    def operand(self, ctx: AsmContext) -> str:
+        return f"[rbp - {8 + 8 * self.var}]"
+    def to_asm(self, ctx: AsmContext):
+        ctx.emit(f"lea rax, {self.operand(ctx)}")
     def pretty_print(self, depth = 0) -> str:
         return f"&({self.var})"
 
@@ -272,40 +432,48 @@ class MemberAddress:
     """returns ith member field address"""
     obj: Expr
     i: int
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            {self.obj.to_asm(ctx)}
-            {get_addr_from_rax()}
-            add rax, {8 * self.i}
-        """
+    def to_asm(self, ctx: AsmContext):
+        self.obj.to_asm(ctx)
+        emit_addr_from_rax(ctx)
+        ctx.emit(f"add rax, {8 * self.i}")
     def pretty_print(self, depth = 0) -> str:
         return f"&({self.obj.pretty_print(depth)}).{self.i}"
 
 @dataclass
 class Deref:
     address: Expr
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            {self.address.to_asm(ctx)}
-            mov rax, [rax]
-        """
+    def to_asm(self, ctx: AsmContext):
+        if isinstance(self.address, (ArgAddress, VarAddress)):
+            ctx.emit(f"mov rax, {self.address.operand(ctx)}")
+            return
+        self.address.to_asm(ctx)
+        ctx.emit("mov rax, [rax]")
     def pretty_print(self, depth = 0) -> str:
         s = self.address.pretty_print(depth)
         return s[1:] if isinstance(self.address, (ArgAddress, VarAddress, MemberAddress)) else '*' + s
 
+def register_operand(expr: Expr, ctx: AsmContext) -> str | None:
+    """operand to load value of expression to a register with a single mov, if there is one"""
+    if isinstance(expr, IntValue):
+        return f"{expr.value}"
+    if isinstance(expr, Deref) and isinstance(expr.address, (ArgAddress, VarAddress)):
+        return expr.address.operand(ctx)
+    return None
+
 @dataclass
 class Assign:
     """assigns *var = obj """
     var: Expr
     obj: Expr
-    def to_asm(self, ctx: AsmContext) -> str:
-        return f"""
-            {self.var.to_asm(ctx)}
-            push rax
-            {self.obj.to_asm(ctx)}
-            pop rcx
-            mov [rcx], rax
-        """
+    def to_asm(self, ctx: AsmContext):
+        if isinstance(self.var, (ArgAddress, VarAddress)):
+            self.obj.to_asm(ctx)
+            ctx.emit(f"mov {self.var.operand(ctx)}, rax")
+            return
+        self.var.to_asm(ctx)
+        ctx.emit("push rax")
+        self.obj.to_asm(ctx)
+        ctx.emit("pop rcx", "mov [rcx], rax")
     def pretty_print(self, depth = 0) -> str:
         return self.var.pretty_print(depth) + " = " + self.obj.pretty_print(depth)
 
@@ -316,17 +484,18 @@ class Print:
     def to_asm(self, ctx: AsmContext):
         str_label = ctx.unique_id("str")
         after_str_label = ctx.unique_id("after_str")
-        return f"""
-            jmp {after_str_label}
-            {str_label}:
-            db {', '.join(str(int(b)) for b in self.value.encode('utf-8'))}
-            {after_str_label}:
-            mov rax, 1
-            mov rdi, 1
-            mov rsi, {str_label}
-            mov rdx, {len(self.value.encode())}
-            syscall
-        """
+        data = self.value.encode('utf-8')
+        ctx.emit(
+            f"jmp {after_str_label}",
+            f"{str_label}:",
+            f"db {', '.join(str(int(b)) for b in data)}" if data else "db",
+            f"{after_str_label}:",
+            "mov rax, 1",
+            "mov rdi, 1",
+            f"mov rsi, {str_label}",
+            f"mov rdx, {len(data)}",
+            "syscall",
+        )
     def pretty_print(self, depth = 0) -> str:
         return f"wrt \"{self.value.replace("\n", "\\n").replace("\t", "\\t")}\""
 
@@ -341,7 +510,9 @@ class Create:
 
     def to_asm(self, ctx: AsmContext):
         if len(self.children) == 0:
-            return Call(FunName("_make_obj0"), [IntValue(self.type_id)] + self.children).to_asm(ctx)
+            # objects without children are just the variant in the highest byte, as made by _make_obj0
+            ctx.emit(f"mov rax, {self.type_id << 56}")
+            return
 
         if len(self.children) == 1:
             return Call(FunName("_make_obj1"), [IntValue(self.type_id)] + self.children).to_asm(ctx)
@@ -359,27 +530,84 @@ class Create:
     def pretty_print(self, depth = 0) -> str:
         return f"({' '.join([f"<{self.type_id}>"] + [child.pretty_print(depth + 1) for child in self.children])})"
 
+def mark_tail_calls(node, tail: bool):
+    """marks calls whose result is the result of the enclosing function, the node itself is in such position if tail"""
+    if isinstance(node, Return):
+        mark_tail_calls(node.content, True)
+    elif isinstance(node, Fit):
+        mark_tail_calls(node.obj, False)
+        for branch in node.branches:
+            mark_tail_calls(branch.content, tail)
+    elif isinstance(node, (Block, Fun)):
+        # rax is returned when the function ends, so the last statement is in tail position
+        statements = node.statements if isinstance(node, Block) else node.content
+        for i, statement in enumerate(statements):
+            mark_tail_calls(statement, tail and i == len(statements) - 1)
+    else:
+        if isinstance(node, Call):
+            node.tail = tail
+        for value in vars(node).values():
+            for child in value if isinstance(value, list) else [value]:
+                if is_dataclass(child):
+                    mark_tail_calls(child, False)
+
+def keeps_args_in_registers(node, ctx: AsmContext) -> bool:
+    """
+    whether code of the node leaves ARG_REGISTERS intact and needs no addresses of arguments.
+    Calls, allocations and syscalls overwrite the registers, except for direct tail calls, which replace arguments.
+    """
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, Deref) and isinstance(node.address, ArgAddress):
+            continue
+        if isinstance(node, Assign) and isinstance(node.var, ArgAddress):
+            nodes.append(node.obj)
+            continue
+        if isinstance(node, (ArgAddress, Print)) or isinstance(node, Create) and node.children:
+            return False
+        if isinstance(node, Call) and not (node.tail and node.is_direct(ctx)):
+            return False
+        if isinstance(node, FitBranch):
+            # patterns are constants
+            nodes.append(node.content)
+            continue
+        for value in vars(node).values():
+            if isinstance(value, list):
+                nodes.extend(value)
+            elif is_dataclass(value):
+                nodes.append(value)
+    return True
+
 def constructor(enum_name: str, variant_id: int, no_args: int) -> Fun:
-    return Fun(constructor_name(enum_name, variant_id), 0, [Return(Create(variant_id, [Deref(ArgAddress(i)) for i in range(no_args)]))])
+    return Fun(constructor_name(enum_name, variant_id), no_args, 0, [Return(Create(variant_id, [Deref(ArgAddress(i)) for i in range(no_args)]))])
 
-def get_addr_from_rax() -> str:
-    return f"""
-        shl rax, 8
-        shr rax, 8
-    """
+def emit_addr_from_rax(ctx: AsmContext):
+    ctx.emit("shl rax, 8", "shr rax, 8")
 
-def get_variant_from_rax() -> str:
-    return f"""
-        shr rax, 56
-    """
+def emit_variant_from_rax(ctx: AsmContext):
+    ctx.emit("shr rax, 56")
 
 class AsmContext:
+    """
+    Nodes emit instructions one line at a time to a list shared by the whole program,
+    so generated code is never copied into the code of enclosing nodes.
+    """
     _id: int
     return_token: str
     var_count: int
+    args_in_registers: bool
+    direct_functions: Dict[str, int]
+    lines: List[str]
 
     def __init__(self):
         self._id = 0
+        self.args_in_registers = False
+        self.direct_functions = {}
+        self.lines = []
+
+    def emit(self, *lines: str):
+        self.lines.extend(lines)
 
     def unique_id(self, name: str) -> str:
         self._id += 1
@@ -387,4 +615,5 @@ class AsmContext:
 
 def compile(program: Program) -> str:
     ctx = AsmContext()
-    return program.to_asm(ctx)
+    program.to_asm(ctx)
+    return '\n'.join(ctx.lines)
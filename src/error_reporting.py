@@ -1,3 +1,4 @@
+import sys
 from dataclasses import dataclass
 from source import Location
 from termcolor import *
@@ -31,13 +32,14 @@ class ErrorReport:
 def print_error(error):
     print(format_error(error))
 
+# warnings do not stop compilation, so they are kept out of the generated assembly on stdout
 def print_warning(warning):
-    print(format_warning(warning))
+    print(format_warning(warning), file=sys.stderr)
 
 def print_error_report(report):
     for warning in report.warnings:
         print_warning(warning)
-        print('\n')
+        print('\n', file=sys.stderr)
 
     for error in report.errors:
         print_error(error)
@@ -99,7 +101,7 @@ def format_single_line_message(message, squiggle_colorizer, line_digits):
     line_index, column_index = location.begin_line_and_column()
     line_index = location.begin_line()
     prefix = f"{line_index + 1:>{line_digits}} | "
-    line = location.source.lines[line_index]
+    line = source_line(location.source, line_index)
     underline_prefix = " " * (len(prefix) + column_index)
     underline = squiggle_colorizer.colored(underline_prefix + "^" * location.len())
     return prefix + line + "\n" + underline + (("\n" + message.comment) if message.comment else "")
@@ -114,7 +116,7 @@ def format_multi_line_message(message, squiggle_colorizer, line_digits):
     \\-^^^^^^^^^^^
     '''
     locations = message.location.split_lines()
-    source_lines = [s.source.lines[s.begin_line()] for s in locations]
+    source_lines = [source_line(s.source, s.begin_line()) for s in locations]
     first_underline = squiggle_colorizer.colored(
         "-" * locations[0].begin_column() + "^" * locations[0].len())
     last_underline = squiggle_colorizer.colored("^" * locations[-1].len())
@@ -146,6 +148,14 @@ def format_multi_line_message(message, squiggle_colorizer, line_digits):
     return code + (("\n" + message.comment) if message.comment else "")
 
 
+def source_line(source, line_index):
+    '''
+    End of file is located after the last line when the source ends
+    with a newline, on a line that is empty
+    '''
+    return source.lines[line_index] if line_index < len(source.lines) else ""
+
+
 def message_lines(message):
     return [s.begin_line() + 1 for s in message.location.split_lines()]
 
@@ -1,184 +1,226 @@
 from typing import *
 
-from dataclasses import dataclass
-from enum import Enum, auto
+import re
 import string
+from bisect import bisect_left
+from itertools import accumulate, compress
+from operator import sub
 
 from tokens import *
 
-class RawTokenKind(Enum):
-    Alphanumeric = auto()
-    Symbolic = auto()
-    Whitespace = auto()
-    Comment = auto()
-    StringLiteral = auto()
+WHITESPACE = ' \t\n\r\x0b\x0c'
 
-@dataclass
-class RawToken:
-    text: str
-    kind: RawTokenKind
-    location: Location
+RAW_TOKENS = [
+    ('Alphanumeric', r'\w++'),
+    ('InlineComment', r'//[^\n]*+'),
+    ('MultilineComment', r'/\*'),
+    ('Symbolic', r'[.,:;?!<=>+\-/*%^|&]++'),
+    ('Delim', r'[\[\](){}]'),
+    ('StringLiteral', r'"[^"]*+"?'),
+    ('Unexpected', r'[^ \t\n\r\x0b\x0c]'),
+]
 
+RAW_TOKEN_REGEX = re.compile('|'.join(f'(?P<{kind}>{regex})' for kind, regex in RAW_TOKENS))
 
+# Every character other than whitespace starts a raw token, so raw tokens
+# with whitespace before them found from some index cover the text up to the last one.
+# Nothing follows a raw token, so backtracking into it is never needed
+SPACED_RAW_TOKEN_REGEX = re.compile(f'[{WHITESPACE}]*+(?>{'|'.join(regex for _, regex in RAW_TOKENS)})')
 
-class TextCursor:
-    def __init__(self, source):
-        self.source = source
-        self.index = 0
-        self.eaten_index = 0
+COMMENT_DELIM_REGEX = re.compile(r'/\*|\*/')
 
-    def peek(self, n=1) -> str | None:
-        if self.index + n <= len(self.source.text):
-            return self.source.text[self.index:self.index+n]
+# Source is lexed in segments ending at the first newline after this many characters
+SEGMENT_CHARS = 2**14
 
-    def advance(self, n=1):
-        self.index += n
+# Kind ids of inline comments, which are dropped, and of openings of multiline comments
+COMMENT = -1
+MULTILINE_COMMENT = -2
 
-    def eaten(self):
-        result = self.source.text[self.eaten_index:self.index]
-        location = Location(self.source, self.eaten_index, self.index)
-        self.eaten_index = self.index
-        return result, location
 
-    def has(self, n=1):
-        return self.index + n <= len(self.source.text)
-
-
-def lex(source: Source) -> List[Token]:
-    cursor = TextCursor(source)
-    tokens = []
-    while cursor.has():
-        raw_token = lex_raw_token(cursor)
-        tokens += cook_token(raw_token)
-
-    tokens.append(Token("<eof>", EofKind.Eof, source.eof()))
+def lex(source: Source) -> TokenStore:
+    '''
+    Splits source into tokens, skipping whitespace and comments.
+    Tokens are stored as kind ids and spans, Token objects are created
+    only when the store is read.
+    '''
+    tokens = TokenStore(source)
+    for segment in lex_segments(source):
+        tokens.extend(segment)
     return tokens
 
 
-def cook_token(token: RawToken) -> List[TokenKind]:
-    if token.text in SYMBOL_MAP:
-        return [Token(token.text, SYMBOL_MAP[token.text], token.location)]
-    elif token.kind == RawTokenKind.Whitespace or token.kind == RawTokenKind.Comment:
-        return []
-    elif token.kind == RawTokenKind.Alphanumeric:
-        if token.text in KEYWORD_MAP:
-            return [Token(token.text, KEYWORD_MAP[token.text], token.location)]
-        if token.text.isdigit():
-            return [Token(token.text, NumberKind.Integer, token.location)]
-        elif token.text[0] in string.ascii_uppercase:
-            return [Token(token.text, NameKind.EnumName, token.location)]
+def lex_stream(source: Source) -> Iterator[Token]:
+    '''
+    Lazily splits source into tokens, so the parser can consume them
+    as they are found without the whole program being stored.
+    '''
+    for segment in lex_segments(source):
+        yield from segment
+
+
+def lex_segments(source: Source) -> Iterator[TokenStore]:
+    '''
+    Yields tokens of consecutive segments of source.
+    Raw tokens of a segment are found by a single findall, and their spans and kinds
+    are computed for the whole segment at once without running Python code per token:
+    spans follow from lengths of raw tokens, and kinds and lengths without whitespace
+    are looked up by raw token, which is classified once per distinct raw token.
+    Segments with tokens that need a diagnostic or splitting are cooked token by token instead.
+    '''
+    text = source.text
+    kind_ids = RawKindIds()
+    lengths = RawLengths()
+    index = 0
+    while index < len(text):
+        end = text.find('\n', index + SEGMENT_CHARS)
+        end = len(text) if end == -1 else end
+        raw = SPACED_RAW_TOKEN_REGEX.findall(text, index, end)
+        if raw and raw[-1].lstrip(WHITESPACE)[0] == '"' and end < len(text):
+            # only string literals span lines, so the segment is extended to the end of the last one
+            end = text.find('"', index + sum(map(len, raw)) - lengths[raw[-1]] + 1) + 1 or len(text)
+            raw = SPACED_RAW_TOKEN_REGEX.findall(text, index, end)
+
+        ids = list(map(kind_ids.__getitem__, raw))
+        ends = list(accumulate(map(len, raw), initial=index))
+        del ends[0]
+        begins = list(map(sub, ends, map(lengths.__getitem__, raw)))
+        index = skip_multiline_comments(text, ids, begins, ends) or end
+
+        if COMMENT in ids:
+            kept = list(map(COMMENT.__ne__, ids))
+            ids = list(compress(ids, kept))
+            begins = compress(begins, kept)
+            ends = compress(ends, kept)
+
+        tokens = TokenStore(source)
+        if None in ids:
+            for begin in begins:
+                cook_match(tokens, RAW_TOKEN_REGEX.match(text, begin))
         else:
-            return [Token(token.text, NameKind.VarName, token.location)]
-    elif token.kind == RawTokenKind.Symbolic:
-        result = []
-        for i, symbol in enumerate(token.text):
-            location = Location(token.location.source, token.location.begin + i, token.location.begin + i + 1)
-            result.append(Token(symbol, SYMBOL_MAP.get(symbol, ErrorKind.Error), location))
-        return result
-    elif token.kind == RawTokenKind.StringLiteral:
-        if len(token.text) >= 2 and token.text[-1] == '"':
-            return [Token(token.text, StringKind.String, token.location)]
+            tokens.kinds.extend(ids)
+            tokens.begins.extend(begins)
+            tokens.ends.extend(ends)
+        yield tokens
+
+    eof = source.eof()
+    tokens = TokenStore(source)
+    tokens.append(EofKind.Eof, eof.begin, eof.end)
+    yield tokens
+
+
+def skip_multiline_comments(text: str, ids: list[int | None], begins: list[int], ends: list[int]) -> int | None:
+    '''
+    The regex cannot balance nested comments, so raw tokens of multiline comments
+    are removed here. Raw tokens after a comment are kept when one ended where
+    the comment ends, otherwise the rest of the segment is removed and
+    the index to resume lexing at is returned.
+    '''
+    if MULTILINE_COMMENT not in ids:
+        return None
+    comment = ids.index(MULTILINE_COMMENT)
+    while comment != -1:
+        comment_end = multiline_comment_end(text, begins[comment])
+        last = bisect_left(ends, comment_end)
+        if last == len(ends) or ends[last] != comment_end:
+            del ids[comment:], begins[comment:], ends[comment:]
+            return comment_end
+        del ids[comment:last + 1], begins[comment:last + 1], ends[comment:last + 1]
+        comment = ids.index(MULTILINE_COMMENT, comment) if MULTILINE_COMMENT in ids else -1
+    return None
+
+
+class RawKindIds(dict):
+    '''
+    Maps raw tokens, with whitespace before them, to ids of their kinds, computed on first lookup.
+    Comments map to COMMENT and MULTILINE_COMMENT, and texts that are not a single valid token map to None.
+    Comments and string literals are rarely repeated, so they are not stored.
+    '''
+    def __missing__(self, raw: str) -> int | None:
+        text = raw.lstrip(WHITESPACE)
+        kind = RAW_TOKEN_REGEX.match(text).lastgroup
+        if kind == 'InlineComment':
+            return COMMENT
+        if kind == 'StringLiteral':
+            return KIND_IDS[StringKind.String] if len(text) >= 2 and text[-1] == '"' else None
+
+        if kind == 'Alphanumeric':
+            kind_id = KIND_IDS[cook_alphanumeric(text)]
+        elif kind == 'MultilineComment':
+            kind_id = MULTILINE_COMMENT
+        elif kind in ('Delim', 'Symbolic') and text in SYMBOL_MAP:
+            kind_id = KIND_IDS[SYMBOL_MAP[text]]
         else:
-            print("Unterminated string: ", token.text)
+            kind_id = None
+        self[raw] = kind_id
+        return kind_id
+
+
+class RawLengths(dict):
+    '''
+    Maps raw tokens to lengths of their texts without whitespace before them.
+    Comments and string literals are rarely repeated, so they are not stored.
+    '''
+    def __missing__(self, raw: str) -> int:
+        text = raw.lstrip(WHITESPACE)
+        if not text.startswith(('//', '"')):
+            self[raw] = len(text)
+        return len(text)
+
+
+def cook_match(tokens: TokenStore, match: re.Match):
+    kind = match.lastgroup
+    begin, end = match.span()
+    if kind == 'Alphanumeric':
+        tokens.append(cook_alphanumeric(match.group()), begin, end)
+    elif kind == 'Delim':
+        tokens.append(SYMBOL_MAP[match.group()], begin, end)
+    elif kind == 'Symbolic':
+        for kind, begin, end in cook_symbolic(match.group(), begin):
+            tokens.append(kind, begin, end)
+    elif kind == 'StringLiteral':
+        tokens.append(cook_string_literal(match.group()), begin, end)
+    elif kind == 'Unexpected':
+        print("unexpected: ", match.group())
+        tokens.append(ErrorKind.Error, begin, end)
+
+
+def cook_alphanumeric(text: str) -> TokenKind:
+    if text in SYMBOL_MAP:
+        return SYMBOL_MAP[text]
+    elif text in KEYWORD_MAP:
+        return KEYWORD_MAP[text]
+    elif text.isdigit():
+        return NumberKind.Integer
+    elif text[0] in string.ascii_uppercase:
+        return NameKind.EnumName
     else:
-        print("Unexpected: ", token)
-
-def lex_raw_token(cursor: TextCursor):
-    if is_space(cursor):
-        text, location = lex_space(cursor)
-        return RawToken(text, RawTokenKind.Whitespace, location)
-    elif is_inline_comment(cursor):
-        text, location = lex_inline_comment(cursor)
-        return RawToken(text, RawTokenKind.Comment, location)
-    elif is_multiline_comment(cursor):
-        text, location = lex_multiline_comment(cursor)
-        return RawToken(text, RawTokenKind.Comment, location)
-    elif is_alnum(cursor):
-        text, location = lex_alnum(cursor)
-        return RawToken(text, RawTokenKind.Alphanumeric, location)
-    elif is_symbolic(cursor):
-        text, location = lex_symbolic(cursor)
-        return RawToken(text, RawTokenKind.Symbolic, location)
-    elif is_delim(cursor):
-        text, location = lex_delim(cursor)
-        return RawToken(text, RawTokenKind.Symbolic, location)
-    elif is_quote(cursor):
-        text, location = lex_string_literal(cursor)
-        return RawToken(text, RawTokenKind.StringLiteral, location)
-    else:
-        print("unexpected: ", cursor.peek())
-
-
-def is_space(cursor: TextCursor):
-    return cursor.peek() in string.whitespace
-
-def is_alnum(cursor: TextCursor):
-    return cursor.peek().isalnum() or cursor.peek() == "_"
-
-DELIMS = "[](){}"
-SYMBOLS = ".,:;?!<=>+-/*%^|&"
-def is_symbolic(cursor: TextCursor):
-    return cursor.peek() in SYMBOLS
-
-def is_delim(cursor: TextCursor):
-    return cursor.peek() in DELIMS
+        return NameKind.VarName
 
-def is_quote(cursor: TextCursor):
-    return cursor.peek() == "\""
 
-def is_inline_comment(cursor: TextCursor):
-    return cursor.peek(2) == "//"
-
-def is_multiline_comment(cursor: TextCursor):
-    return cursor.peek(2) == "/*"
-
-def lex_space(cursor: TextCursor):
-    while cursor.has() and is_space(cursor):
-        cursor.advance()
-    return cursor.eaten()
-
-def lex_alnum(cursor: TextCursor):
-    while cursor.has() and is_alnum(cursor):
-        cursor.advance()
-    return cursor.eaten()
-
-def lex_symbolic(cursor: TextCursor):
-    while cursor.has() and is_symbolic(cursor):
-        cursor.advance()
-    return cursor.eaten()
-
-def lex_delim(cursor: TextCursor):
-    cursor.advance()
-    return cursor.eaten()
+def cook_symbolic(text: str, begin: int) -> Iterator[Tuple[TokenKind, int, int]]:
+    if text in SYMBOL_MAP:
+        yield SYMBOL_MAP[text], begin, begin + len(text)
+    else:
+        for i, symbol in enumerate(text):
+            yield SYMBOL_MAP.get(symbol, ErrorKind.Error), begin + i, begin + i + 1
 
-def lex_string_literal(cursor: TextCursor):
-    cursor.advance()
-    while cursor.has() and not is_quote(cursor):
-        cursor.advance()
-    if cursor.has():
-        cursor.advance()
-    return cursor.eaten()
 
-def lex_inline_comment(cursor: TextCursor):
-    while cursor.has() and cursor.peek() != "\n":
-        cursor.advance()
-    if cursor.has():
-        cursor.advance()
-    return cursor.eaten()
+def cook_string_literal(text: str) -> TokenKind:
+    if len(text) >= 2 and text[-1] == '"':
+        return StringKind.String
+    else:
+        print("Unterminated string: ", text)
+        return ErrorKind.Error
 
 
-def lex_multiline_comment(cursor: TextCursor):
+def multiline_comment_end(text: str, begin: int) -> int:
+    '''
+    Multiline comments can be nested, so the comment ends
+    where its opening /* is balanced by */
+    '''
     open_comments = 0
-    while cursor.has():
-        if cursor.peek(2) == "/*":
-            open_comments += 1
-            cursor.advance(2)
-        elif cursor.peek(2) == "*/":
-            cursor.advance(2)
-            open_comments -= 1
-        else:
-            cursor.advance(1)
-
+    for match in COMMENT_DELIM_REGEX.finditer(text, begin):
+        open_comments += 1 if match.group() == '/*' else -1
         if open_comments == 0:
-            break
-    return cursor.eaten()
+            return match.end()
+    return len(text)
@@ -1,47 +1,96 @@
-from lex import lex
+from lex import lex, lex_stream
 from parsing.parse import parse
 from tree import ProgramNode
 from tokens import Source
 from typechecking.typechecker import typecheck
+from typechecking.incremental import TypecheckCache
 from ast_to_ll import to_ll
 from compiler import compile
-from parsing.combinators import Result, ResultStatus
+from parsing.combinators import Result, ResultStatus, PackratMemo
 from error_reporting import print_error, print_error_report
+from profiling import PassProfiler, count_objects
+from typechecking.types import InternedTy
+import os
 import sys
 
 def run_file(file):
+    profile_json = next((arg.removeprefix('--profile-json=') for arg in sys.argv if arg.startswith('--profile-json=')), None)
+    profiler = PassProfiler('--time-passes' in sys.argv or profile_json is not None)
+
+    run_passes(file, profiler)
+
+    if '--time-passes' in sys.argv:
+        print(profiler, file=sys.stderr)
+    if profile_json is not None:
+        with open(profile_json, "w") as f:
+            f.write(profiler.to_json(file))
+
+def run_passes(file, profiler):
     with open(file, "r") as f:
         source = Source(file, f.read())
 
-    tokens = lex(source)
-
     if '--tokens' in sys.argv:
-        print(tokens)
+        print(lex(source))
         return
 
-    parsing_result = parse(tokens)
+    # the parser pulls tokens from the lexer as it goes, unless lexing is profiled as a pass of its own
+    if profiler.enabled:
+        tokens = profiler.run('lex', {'tokens': len}, lex, source)
+    else:
+        tokens = lex_stream(source)
+
+    memo = PackratMemo() if '--packrat' in sys.argv else None
+    parsing_result = profiler.run(
+        'parse', {'ast_nodes': lambda result: count_objects(result.parsed, 'tree')},
+        parse, tokens, memo, True,
+    )
+
+    if memo is not None:
+        print(memo, file=sys.stderr)
 
     if '--parse' in sys.argv:
         print(parsing_result)
         return
 
+    for error in parsing_result.errors:
+        print_error(error)
+
     if parsing_result.status == ResultStatus.Ok:
         program = parsing_result.parsed
 
-        ctx, report = typecheck(program)
+        workers = os.cpu_count() if '--parallel' in sys.argv else None
+        cache = TypecheckCache.load(file + '.typecache') if '--incremental' in sys.argv else None
+        if workers is not None and cache is not None:
+            print("warning: --parallel is ignored with --incremental, functions are typechecked in one process", file=sys.stderr)
+            workers = None
+        check_only = '--check' in sys.argv
+        ctx, report = profiler.run(
+            'typecheck', {'types': lambda _: len(InternedTy.instances)},
+            typecheck, program, workers, cache, not check_only, workers=workers,
+        )
+
+        if cache is not None:
+            cache.save()
+            print(cache, file=sys.stderr)
         print_error_report(report)
 
-        if not report.has_errors():
-            program = to_ll(program, ctx)
+        if check_only:
+            return
+
+        if not parsing_result.errors and not report.has_errors():
+            program = profiler.run('to_ll', {'ll_nodes': lambda ll: count_objects(ll, 'compiler')}, to_ll, program, ctx)
+
+            if '--instantiation-stats' in sys.argv:
+                stats = str(ctx.instantiations)
+                print(stats if workers is None else f"{stats} (parent process only)", file=sys.stderr)
 
             if '--ll' in sys.argv:
                 print(program.pretty_print())
                 return
-            if '--compile' in sys.argv:
-                print(compile(program))
-    else:
-        for error in parsing_result.errors:
-            print_error(error)
+            if '--compile' in sys.argv or profiler.enabled:
+                asm = profiler.run('compile', {'asm_lines': lambda asm: asm.count('\n') + 1}, compile, program)
+                if '--compile' in sys.argv:
+                    print(asm)
 
 
 if __name__ == "__main__":
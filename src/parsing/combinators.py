@@ -2,25 +2,43 @@ from typing import *
 from enum import Enum, auto
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
-from tokens import Token, KIND_TO_STR
+from tokens import Token, TokenKind, KeywordKind, DelimKind, EofKind, KIND_TO_STR
 from source import *
 from error_reporting import *
 
 class TokenCursor:
-    def __init__(self, tokens, index=0):
-        self.tokens = tokens
-        self.index = index
+    '''
+    Cursor over a token stream.
+    Tokens are pulled from the stream on demand and buffered, so the parser
+    can save and restore positions. The buffer is released at every checkpoint,
+    so it only holds tokens of the top-level item being parsed.
+    '''
+    def __init__(self, tokens, memo=None, recover=False):
+        self.tokens = iter(tokens)
+        self.buffer = []
+        self.offset = 0
+        self.index = 0
+        self.memo = memo
+        self.recover = recover
+
+    def fill(self):
+        while self.index - self.offset >= len(self.buffer):
+            token = next(self.tokens, None)
+            if token is None:
+                return False
+            self.buffer.append(token)
+        return True
 
     def has(self):
-        return self.index < len(self.tokens)
+        return self.fill()
 
     def peek(self):
         if not self.has():
-            return self.eof()
-        return self.tokens[self.index]
+            return self.prev()
+        return self.buffer[self.index - self.offset]
 
     def take(self):
-        result = self.tokens[self.index]
+        result = self.peek()
         self.index += 1
         return result
 
@@ -31,7 +49,52 @@ class TokenCursor:
         self.index = index
 
     def prev(self):
-        return self.tokens[self.index - 1]
+        return self.buffer[self.index - 1 - self.offset]
+
+    def checkpoint(self):
+        # keep the previous token, parsers use it to compute locations
+        released = self.index - 1 - self.offset
+        if released > 0:
+            del self.buffer[:released]
+            self.offset += released
+        if self.memo is not None:
+            self.memo.clear()
+
+
+class PackratMemo:
+    '''
+    Memo table for packrat parsing, keyed by (parser id, cursor index, backtracking).
+    Holds at most `capacity` entries, evicting the oldest first,
+    and is cleared at every top-level item.
+    '''
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.table.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if len(self.table) >= self.capacity:
+            del self.table[next(iter(self.table))]
+            self.evictions += 1
+        self.table[key] = entry
+
+    def clear(self):
+        self.table.clear()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f"packrat memo: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {self.evictions} evictions"
 
 
 class ResultStatus(Enum):
@@ -45,20 +108,30 @@ class ResultStatus(Enum):
     Err = auto()
     Backtracked = auto()
 
-@dataclass
+# Results without errors share one empty error list, so it must not be modified
+NO_ERRORS = ()
+
+@dataclass(slots=True)
 class Result[T]:
+    '''
+    Result of running a parser.
+    Backtracked results without errors are a shared instance,
+    so only Ok results may be updated in place.
+    '''
     status: ResultStatus
     parsed: T | None
     errors: List[Error]
 
     def Ok(parsed, errors=None):
-        return Result(ResultStatus.Ok, parsed, errors or [])
+        return Result(ResultStatus.Ok, parsed, errors or NO_ERRORS)
 
     def Backtracked(errors=None):
-        return Result(ResultStatus.Backtracked, None, errors or [])
+        if not errors:
+            return BACKTRACKED
+        return Result(ResultStatus.Backtracked, None, errors)
 
     def Err(errors=None):
-        return Result(ResultStatus.Err, None, errors or [])
+        return Result(ResultStatus.Err, None, errors or NO_ERRORS)
 
     def map(self, mapper):
         if self.status != ResultStatus.Ok:
@@ -66,6 +139,17 @@ class Result[T]:
         else:
             return ResultStatus.Ok(mapper(self.parsed))
 
+BACKTRACKED = Result(ResultStatus.Backtracked, None, NO_ERRORS)
+
+
+def with_errors(errors, result):
+    '''
+    Prepends errors recovered from earlier to the result
+    '''
+    if not errors:
+        return result
+    return Result(result.status, result.parsed, [*errors, *result.errors])
+
 
 class Parser[T](ABC):
     @abstractmethod
@@ -84,6 +168,17 @@ class Parser[T](ABC):
     def and_then(self, mapper):
         return AndThen(self, mapper)
 
+    def memoized(self):
+        return Memoized(self)
+
+    def first_set(self) -> FrozenSet[TokenKind] | None:
+        '''
+        Kinds of tokens the parser can start with.
+        When the next token is not in the set, the parser run with backtracking backtracks.
+        None means the set is unknown, e.g. because the parser may succeed without consuming anything.
+        '''
+        return None
+
 
 class BuilderParser(Parser):
     class Commit:
@@ -101,6 +196,7 @@ class BuilderParser(Parser):
     def __init__(self, builder):
         self.builder = builder
         self.parts = []
+        self.steps = None
 
     def commit(self):
         self.parts.append(BuilderParser.Commit())
@@ -114,23 +210,48 @@ class BuilderParser(Parser):
         self.parts.append(BuilderParser.Parse(parser, builder_method))
         return self
 
+    def compile_steps(self):
+        '''
+        Flattens parts into (parser, builder method) pairs.
+        Commit is a step without a parser, Drop is a step without a builder method.
+        '''
+        steps = []
+        for part in self.parts:
+            if isinstance(part, BuilderParser.Commit):
+                steps.append((None, None))
+            elif isinstance(part, BuilderParser.Drop):
+                steps.append((part.parser, None))
+            else:
+                steps.append((part.parser, part.builder_method))
+        return steps
+
+    def first_set(self):
+        if not self.parts or isinstance(self.parts[0], BuilderParser.Commit):
+            return None
+        return self.parts[0].parser.first_set()
+
     def run(self, cursor, backtracking):
+        if self.steps is None:
+            self.steps = self.compile_steps()
         builder = self.builder()
         begin = cursor.peek().location
-        for part in self.parts:
-            if isinstance(part, BuilderParser.Commit):
+        errors = NO_ERRORS
+        for parser, builder_method in self.steps:
+            if parser is None:
                 backtracking = False
             else:
-                result = part.parser.run(cursor, backtracking)
+                result = parser.run(cursor, backtracking)
                 if result.status != ResultStatus.Ok:
-                    return result
-                elif isinstance(part, BuilderParser.Parse):
-                    part.builder_method(builder, result.parsed)
+                    return with_errors(errors, result)
+                if result.errors:
+                    errors = [*errors, *result.errors]
+                if builder_method is not None:
+                    builder_method(builder, result.parsed)
         end = cursor.prev().location
         location = Location.wrap(begin, end)
         if location.begin >= location.end:
             location.end = location.begin + 1
-        return Result.Ok(builder.build(location))
+        return Result.Ok(builder.build(location), errors)
 
     def __repr__(self):
         return f"BuilderParser({self.builder})"
@@ -141,6 +262,9 @@ class Mapped(Parser):
         self.parser = parser
         self.mapper = mapper
 
+    def first_set(self):
+        return self.parser.first_set()
+
     def run(self, cursor, backtracking=False):
         result = self.parser.run(cursor, backtracking)
         if result.status == ResultStatus.Ok:
@@ -152,6 +276,9 @@ class AndThen(Parser):
         self.parser = parser
         self.mapper = mapper
 
+    def first_set(self):
+        return self.parser.first_set()
+
     def run(self, cursor, backtracking=False):
         result = self.parser.run(cursor, backtracking)
         if result.status == ResultStatus.Ok:
@@ -161,49 +288,164 @@ class AndThen(Parser):
 
 
 class Repeat[T](Parser):
-    def __init__(self, parser, minimum=0):
+    '''
+    Parses items until the parser backtracks.
+    When the cursor is in recovery mode and `recovery` is given,
+    an item that fails is replaced by `recovery.error_node`
+    and parsing continues after the tokens skipped by `recovery`.
+    '''
+    def __init__(self, parser, minimum=0, recovery=None):
         self.parser = parser
         self.minimum = minimum
+        self.recovery = recovery
+
+    def first_set(self):
+        if self.minimum == 0:
+            return None
+        return self.parser.first_set()
 
     def run(self, cursor, backtracking=False) -> Result[List[T]]:
         cursor_state = cursor.save()
         result = []
+        errors = NO_ERRORS
         while True:
             if not cursor.has():
                 break
             if len(result) >= self.minimum:
                 backtracking = True
+            item_state = cursor.save()
             parsed = self.parser.run(cursor, backtracking)
             if parsed.status == ResultStatus.Ok:
                 result.append(parsed.parsed)
+                if parsed.errors:
+                    errors = [*errors, *parsed.errors]
             elif parsed.status == ResultStatus.Backtracked:
                 break
+            elif self.recovery is not None and cursor.recover:
+                errors = [*errors, *parsed.errors]
+                result.append(self.recovery.recover(cursor, item_state))
+                if cursor.save() == item_state:
+                    break
             else:
-                return parsed
+                return with_errors(errors, parsed)
 
         if len(result) < self.minimum:
             cursor.restore(cursor_state)
             return Result.Backtracked()
 
-        return Result.Ok(result)
+        return Result.Ok(result, errors)
+
+
+class Recovery:
+    '''
+    Describes how to resynchronize after a failed item.
+    Tokens are skipped until one of `before` kinds, or past one of `after` kinds,
+    outside of any braces opened by the item or while skipping.
+    Skipping always stops before a top-level keyword or the end of input.
+    '''
+    STOP_KINDS = frozenset([KeywordKind.KwFun, KeywordKind.KwDis, EofKind.Eof])
+
+    def __init__(self, error_node, before=(), after=()):
+        self.error_node = error_node
+        self.before = frozenset(before)
+        self.after = frozenset(after)
+
+    def skip(self, cursor, depth):
+        while cursor.has():
+            kind = cursor.peek().kind
+            if kind in Recovery.STOP_KINDS or (depth == 0 and kind in self.before):
+                return
+            cursor.take()
+            if depth == 0 and kind in self.after:
+                return
+            depth = Recovery.nest(depth, kind)
+
+    def nest(depth, kind):
+        if kind == DelimKind.OpenBrace:
+            return depth + 1
+        elif kind == DelimKind.CloseBrace:
+            return max(depth - 1, 0)
+        return depth
+
+    def recover(self, cursor, item_state):
+        error_state = cursor.save()
+        cursor.restore(item_state)
+        begin = cursor.peek().location
+        depth = 0
+        while cursor.save() < error_state:
+            depth = Recovery.nest(depth, cursor.take().kind)
+        self.skip(cursor, depth)
+        # an item that failed on a synchronizing token still has to consume it
+        if cursor.save() == item_state and cursor.peek().kind != EofKind.Eof:
+            cursor.take()
+        end = cursor.prev().location if cursor.save() > item_state else begin
+        node = self.error_node()
+        node.location = Location.wrap(begin, end)
+        return node
 
 
 class Alternative[T, U](Parser[T | U]):
+    '''
+    Tries alternatives in order, all but the last one with backtracking.
+    A chain of alternatives is flattened on first use and the alternatives
+    are dispatched by the kind of the next token using their FIRST sets,
+    so only alternatives that can start with that token are tried.
+    '''
     def __init__(self, left: Parser[T], right: Parser[U]):
         self.left = left
         self.right = right
+        self.dispatch = None
+
+    def alternatives(self):
+        alternatives = []
+        for parser in (self.left, self.right):
+            if isinstance(parser, Alternative):
+                alternatives += parser.alternatives()
+            else:
+                alternatives.append(parser)
+        return alternatives
+
+    def first_set(self):
+        first_sets = [parser.first_set() for parser in self.alternatives()]
+        if None in first_sets:
+            return None
+        return frozenset().union(*first_sets)
+
+    def build_dispatch(self):
+        '''
+        Maps token kinds to alternatives (except the last one) that can start with them.
+        Alternatives with unknown FIRST sets are tried for every kind.
+        '''
+        *tried, self.last = self.alternatives()
+        first_sets = [parser.first_set() for parser in tried]
+        kinds = set().union(*(first for first in first_sets if first is not None))
+        self.tried = tuple(tried)
+        self.fallback = tuple(parser for parser, first in zip(tried, first_sets) if first is None)
+        self.dispatch = {
+            kind : tuple(parser for parser, first in zip(tried, first_sets) if first is None or kind in first)
+            for kind in kinds
+        }
 
     def run(self, cursor, backtracking=False) -> Result[T | U]:
-        cursor_state = cursor.save()
-        result = self.left.run(cursor, backtracking=True)
-        if result.status == ResultStatus.Ok or result.status == ResultStatus.Err:
-            return result
+        if self.dispatch is None:
+            self.build_dispatch()
+        if cursor.has():
+            tried = self.dispatch.get(cursor.peek().kind, self.fallback)
         else:
+            tried = self.tried
+
+        cursor_state = cursor.save()
+        for parser in tried:
+            result = parser.run(cursor, backtracking=True)
+            if result.status == ResultStatus.Ok or result.status == ResultStatus.Err:
+                return result
             cursor.restore(cursor_state)
-            return self.right.run(cursor, backtracking)
+        return self.last.run(cursor, backtracking)
 
 class SequenceParser[T](Parser[T]):
     class ListBuilder:
+        __slots__ = ('list',)
+
         def __init__(self):
             self.list = []
 
@@ -228,6 +470,9 @@ class SequenceParser[T](Parser[T]):
         self.builder.commit()
         return self
 
+    def first_set(self):
+        return self.builder.first_set()
+
     def run(self, cursor, backtracking=False) -> Result[List[T]]:
         return self.builder.run(cursor, backtracking)
 
@@ -250,8 +495,7 @@ class OptionalParser[T](Parser):
     def run(self, cursor, backtracking=False) -> Result[List[T]]:
         result = self.parser.run(cursor, True)
         if result.status == ResultStatus.Backtracked:
-            result.status = ResultStatus.Ok
-            result.parsed = self.default
+            return Result.Ok(self.default, result.errors)
         return result
 
 
@@ -262,9 +506,15 @@ class Interspersed(Parser):
         self.minimum = minimum
         self.trailing = trailing
 
+    def first_set(self):
+        if self.minimum == 0:
+            return None
+        return self.parser.first_set()
+
     def run(self, cursor, backtracking=False):
         cursor_state = cursor.save()
         result = []
+        errors = NO_ERRORS
         while True:
             if len(result) >= self.minimum:
                 backtracking = True
@@ -274,6 +524,8 @@ class Interspersed(Parser):
             item = self.parser.run(cursor, backtracking)
             if item.status == ResultStatus.Ok:
                 result.append(item.parsed)
+                if item.errors:
+                    errors = [*errors, *item.errors]
             elif item.status == ResultStatus.Backtracked:
                 if len(result) < self.minimum:
                     cursor.restore(cursor_state)
@@ -281,7 +533,7 @@ class Interspersed(Parser):
                 else:
                     break
             else:
-                return item
+                return with_errors(errors, item)
 
             if len(result) >= self.minimum:
                 backtracking = True
@@ -294,15 +546,18 @@ class Interspersed(Parser):
                 else:
                     break
             elif separator.status == ResultStatus.Err:
-                return separator
+                return with_errors(errors, separator)
 
-        return Result.Ok(result)
+        return Result.Ok(result, errors)
 
 
 class ExpectKind(Parser):
     def __init__(self, kind):
         self.kind = kind
 
+    def first_set(self):
+        return frozenset([self.kind])
+
     def run(self, cursor, backtracking=False):
         if cursor.has() and cursor.peek().kind == self.kind:
             return Result.Ok(cursor.take())
@@ -318,11 +573,84 @@ class ExpectKind(Parser):
 
 
 class Recursive(Parser):
+    '''
+    Parser referring to itself.
+    `inner` receives this parser and returns the grammar built around it.
+    The grammar is built once, on first use, so recursion is a cycle
+    in the parser graph instead of a fresh parser per run.
+    '''
     def __init__(self, inner):
         self.inner = inner
+        self.parser = None
+        self.first = None
+        self.computing_first = False
+
+    def first_set(self):
+        # a parser starting with itself has no known FIRST set
+        if self.computing_first:
+            return None
+        if self.parser is None:
+            self.parser = self.inner(self)
+        if self.first is None:
+            self.computing_first = True
+            self.first = self.parser.first_set()
+            self.computing_first = False
+        return self.first
 
     def run(self, cursor, backtracking=False):
-        return self.inner(self).run(cursor, backtracking)
+        if self.parser is None:
+            self.parser = self.inner(self)
+        return self.parser.run(cursor, backtracking)
+
+
+class Memoized(Parser):
+    '''
+    Remembers results of the inner parser when the cursor has a packrat memo.
+    Ok results are copied in and out of the memo, since combinators
+    such as Mapped update them in place.
+    '''
+    def __init__(self, parser):
+        self.parser = parser
+
+    def first_set(self):
+        return self.parser.first_set()
+
+    def run(self, cursor, backtracking=False):
+        if cursor.memo is None:
+            return self.parser.run(cursor, backtracking)
+
+        key = (id(self), cursor.index, backtracking)
+        entry = cursor.memo.get(key)
+        if entry is None:
+            result = self.parser.run(cursor, backtracking)
+            cursor.memo.put(key, (copy_ok(result), cursor.index))
+            return result
+        else:
+            result, index = entry
+            cursor.restore(index)
+            return copy_ok(result)
+
+
+def copy_ok(result):
+    if result.status == ResultStatus.Ok:
+        return Result(result.status, result.parsed, result.errors)
+    return result
+
+
+class Checkpoint(Parser):
+    '''
+    Marks the start of a top-level item.
+    No parser backtracks past it, so per-item cursor state is dropped here.
+    '''
+    def __init__(self, parser):
+        self.parser = parser
+
+    def first_set(self):
+        return self.parser.first_set()
+
+    def run(self, cursor, backtracking=False):
+        cursor.checkpoint()
+        return self.parser.run(cursor, backtracking)
 
 
 class Unreachable(Parser):
@@ -341,6 +669,9 @@ class Fail(Parser):
     def __init__(self, expected):
         self.expected = expected
 
+    def first_set(self):
+        return frozenset()
+
     def run(self, cursor, backtracking):
         if backtracking:
             return Result.Backtracked()
@@ -32,27 +32,45 @@ def make_expr(parts):
             return Result.Err([Error(msg)])
         new_parts.append(parts[i])
 
-    result = build_expr(new_parts, None)
-    if result.status != ResultStatus.Ok:
+    if isinstance(new_parts[-1], OperatorNode):
+        msg = Message(new_parts[-1].location, f"Expression cannot end with an operator")
+        return Result.Err([Error(msg)])
+
+    return build_expr(new_parts)
+
+def build_expr(nodes):
+    '''
+    Builds expression tree from alternating operands and operators
+    using shunting-yard, so the tree is built in a single pass
+    without recursing per operator.
+    '''
+    operands = [nodes[0]]
+    operators = []
+
+    def reduce():
+        operator = operators.pop()
+        right = operands.pop()
+        left = operands.pop()
+        result = build_node(left, operator, right)
+        if result.status == ResultStatus.Ok:
+            operands.append(result.parsed)
         return result
-    expr, _ = result.parsed
-    return Result.Ok(expr)
-
-def build_expr(nodes, last_operator):
-    left, nodes = nodes[0], nodes[1:]
-    while nodes and right_op_first(last_operator, nodes[0]):
-        operator, nodes = nodes[0], nodes[1:]
-        sub_result = build_expr(nodes, operator)
-        if sub_result.status != ResultStatus.Ok:
-            return sub_result
-        else:
-            right, nodes = sub_result.parsed
-        left_result = build_node(left, operator, right)
-        if left_result.status != ResultStatus.Ok:
-            return left_result
-        else:
-            left = left_result.parsed
-    return Result.Ok((left, nodes))
+
+    for i in range(1, len(nodes), 2):
+        operator = nodes[i]
+        while operators and not right_op_first(operators[-1], operator):
+            result = reduce()
+            if result.status != ResultStatus.Ok:
+                return result
+        operators.append(operator)
+        operands.append(nodes[i + 1])
+
+    while operators:
+        result = reduce()
+        if result.status != ResultStatus.Ok:
+            return result
+
+    return Result.Ok(operands[0])
 
 TOKENS_BUILTINS_MAP = {
     '+': '__builtin_operator_add',
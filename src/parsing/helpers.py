@@ -1,5 +1,6 @@
 from parsing.combinators import *
 from tokens import *
+from tree import ErrorNode
 
 def flatten(items):
     result = []
@@ -50,8 +51,8 @@ def sequence():
 def optional(parser, default):
     return OptionalParser(parser, default)
 
-def repeat(parser):
-    return Repeat(parser)
+def repeat(parser, recovery=None):
+    return Repeat(parser, recovery=recovery)
 
 def repeat_positive(parser):
     return Repeat(parser, minimum=1)
@@ -65,6 +66,12 @@ def fail(message):
 def not_parse(parser):
     return Not(parser)
 
+def checkpoint(parser):
+    return Checkpoint(parser)
+
+def recover(before=(), after=()):
+    return Recovery(ErrorNode, before, after)
+
 
 def interspersed(value_parser, separator_parser, trailing=True):
     return Interspersed(value_parser, separator_parser, trailing=trailing)
@@ -5,20 +5,31 @@ from parsing.combinators import *
 from parsing.helpers import *
 from parsing.expressions import *
 
-def parse(tokens: List[Token]) -> Result:
-    return program_parser().run(TokenCursor(tokens))
+def parse(tokens: Iterable[Token], memo: PackratMemo | None = None, recover: bool = False) -> Result:
+    '''
+    Parses a program.
+    With `recover`, items and statements that fail to parse are replaced by ErrorNodes
+    and the result is Ok with errors of all of them.
+    '''
+    return PROGRAM_PARSER.run(TokenCursor(tokens, memo=memo, recover=recover))
 
 def program_parser():
     return (
         sequence()
-            .then_parse(repeat(item_parser()))
+            .then_parse(repeat(item_parser(), recover()))
             .then_drop(kind(EofKind.Eof))
             .map(flatten)
             .map(ProgramNode)
     )
 
 def item_parser():
-    return enum_parser() | function_parser() | fail("item")
+    return checkpoint(
+        sequence()
+            .then_drop(not_parse(kind(EofKind.Eof)))
+            .commit()
+            .then_parse(enum_parser() | function_parser() | fail("item"))
+            .map(extract)
+    )
 
 def enum_parser():
     variants_parser = braced(interspersed_positive(dis_variant_parser(), kind(SymbolKind.Comma)))
@@ -91,7 +102,7 @@ def type_parser():
                 | fail("type"),
                 ExpectKind(SymbolKind.Arrow),
                 trailing=False)
-            ).and_then(make_type)
+            ).and_then(make_type).memoized()
 
     return Recursive(type_parser_impl)
 
@@ -216,13 +227,17 @@ def block_parser(statement_parser):
             .commit()
             .then_drop(kind(SymbolKind.Semicolon))
     )
+    statements_parser = repeat(
+        single_expr_parser,
+        recover(before=[DelimKind.CloseBrace], after=[SymbolKind.Semicolon])
+    ).map(flatten)
     return (
         builder(BlockNode.Builder)
-            .then_parse(BlockNode.Builder.statements, braced(repeat(single_expr_parser).map(flatten)))
+            .then_parse(BlockNode.Builder.statements, braced(statements_parser))
     )
 def expr_parser():
     def expr_parser_impl(self):
-        return repeat_positive(operator_parser() | expr_term_parser(self) | fail("expression or operator")).and_then(make_expr)
+        return repeat_positive(operator_parser() | expr_term_parser(self) | fail("expression or operator")).and_then(make_expr).memoized()
     return Recursive(expr_parser_impl)
 
 
@@ -255,7 +270,7 @@ def expr_term_parser(expr_parser):
         | var_parser()
         | dis_constructor_parser()
         | fail("expression")
-        )
+        ).memoized()
 
 def statement_parser(expr_parser=expr_parser()):
     def statement_parser_impl(self):
@@ -267,7 +282,7 @@ def statement_parser(expr_parser=expr_parser()):
             | fit_stmt_parser(expr_parser, self)
             | expr_parser
             | fail("statement")
-        )
+        ).memoized()
     return Recursive(statement_parser_impl)
 
 def tuple_like_parser(expr_parser=expr_parser()):
@@ -310,7 +325,7 @@ def variant_pattern_parser():
 
 def pattern_parser():
     def pattern_parser_impl(self):
-        return enum_pattern_parser(self) | catchall_parser() | value_parser() | parenthesized(self) | fail("pattern")
+        return (enum_pattern_parser(self) | catchall_parser() | value_parser() | parenthesized(self) | fail("pattern")).memoized()
     return Recursive(pattern_parser_impl)
 
 def catchall_parser():
@@ -331,3 +346,6 @@ def dis_constructor_parser(type_parser=type_parser()):
             .commit()
             .then_parse(DisConstructorNode.Builder.variant_name, kind(NameKind.EnumName))
     )
+
+
+PROGRAM_PARSER = program_parser()
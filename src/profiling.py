@@ -0,0 +1,75 @@
+import json
+import time
+import tracemalloc
+
+
+def count_objects(root, module: str) -> int:
+    '''Counts objects of classes from the given module reachable from root through attributes and lists'''
+    count = 0
+    stack = [root]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif type(value).__module__ == module and hasattr(value, '__dict__'):
+            count += 1
+            stack.extend(vars(value).values())
+    return count
+
+
+class PassProfiler:
+    '''
+    Measures wall time, CPU time, peak traced memory and sizes of results of compiler passes.
+    Memory is traced with tracemalloc, which slows passes down, so times include its overhead.
+    A disabled profiler only runs the passes.
+    Passes running work in worker processes record their number, CPU time, peak memory
+    and counted objects of such passes cover only the parent process and are listed in 'parent_only'.
+    '''
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.passes = []
+        if enabled:
+            tracemalloc.start()
+
+    def run(self, name: str, counters, function, *args, workers: int | None = None):
+        '''
+        Runs a pass, counters map names of counted objects
+        to functions computing their number from the result of the pass.
+        Workers is the number of worker processes the pass uses, if any.
+        '''
+        if not self.enabled:
+            return function(*args)
+
+        tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = function(*args)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _, peak = tracemalloc.get_traced_memory()
+
+        profile = {
+            'name': name,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'peak_memory_bytes': peak,
+            'objects': {counted: count(result) for counted, count in counters.items()},
+        }
+        if workers is not None:
+            profile['workers'] = workers
+            profile['parent_only'] = ['cpu_seconds', 'peak_memory_bytes', 'objects']
+        self.passes.append(profile)
+        return result
+
+    def to_json(self, file: str) -> str:
+        return json.dumps({'file': file, 'passes': self.passes}, indent=2)
+
+    def __str__(self):
+        lines = [f"{'pass':<10} {'wall':>9} {'cpu':>9} {'peak memory':>12}  objects"]
+        for profile in self.passes:
+            objects = ", ".join(f"{count} {counted.replace('_', ' ')}" for counted, count in profile['objects'].items())
+            if 'workers' in profile:
+                objects += f" (parent process only, {profile['workers']} workers)"
+            lines.append(
+                f"{profile['name']:<10} {profile['wall_seconds']:>8.3f}s {profile['cpu_seconds']:>8.3f}s "
+                f"{profile['peak_memory_bytes'] / 2**20:>8.1f} MiB  {objects}"
+            )
+        return "\n".join(lines)
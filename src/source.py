@@ -1,20 +1,25 @@
 from dataclasses import dataclass
+from bisect import bisect_right
+
+RECENT_LOOKUPS = 256
 
 class Source:
     def __init__(self, name, text):
        self.name = name
        self.text = text
-       self.line_beginnings = [0]
+       self.line_beginnings = find_line_beginnings(text)
        self.lines = text.splitlines()
-       for i, c in enumerate(text):
-           if c == '\n':
-               self.line_beginnings.append(i + 1)
+       self.recent_lookups = {}
 
     def get_line_and_column(self, index):
-        line = 0
-        while line + 1 < len(self.line_beginnings) and self.line_beginnings[line + 1] <= index:
-           line += 1
-        return line, index - self.line_beginnings[line]
+        result = self.recent_lookups.get(index)
+        if result is None:
+            line = bisect_right(self.line_beginnings, index) - 1
+            result = line, index - self.line_beginnings[line]
+            if len(self.recent_lookups) >= RECENT_LOOKUPS:
+                self.recent_lookups.clear()
+            self.recent_lookups[index] = result
+        return result
 
     def split_lines(self, begin, end):
         begin_line, _ = self.get_line_and_column(begin)
@@ -34,7 +39,16 @@ class Source:
     def eof(self):
         return Location(self, len(self.text), len(self.text) + 1)
 
-@dataclass
+
+def find_line_beginnings(text):
+    line_beginnings = [0]
+    newline = text.find('\n')
+    while newline != -1:
+        line_beginnings.append(newline + 1)
+        newline = text.find('\n', newline + 1)
+    return line_beginnings
+
+@dataclass(slots=True)
 class Location:
     source: Source
     begin: int
@@ -1,6 +1,7 @@
 
 from typing import *
 
+from array import array
 from dataclasses import dataclass
 from enum import Enum, auto
 
@@ -111,7 +112,16 @@ KIND_TO_STR = {
     NameKind.EnumName: "uppercase identifier"
 }
 
-@dataclass
+KINDS = [
+    kind
+    for kinds in (KeywordKind, DelimKind, SymbolKind, WhitespaceKind,
+                  NumberKind, StringKind, NameKind, ErrorKind, EofKind)
+    for kind in kinds
+]
+
+KIND_IDS = { kind : i for i, kind in enumerate(KINDS) }
+
+@dataclass(slots=True)
 class Token:
     text: str
     kind: TokenKind
@@ -119,3 +129,42 @@ class Token:
 
     def __repr__(self):
         return f"{self.kind}: \"{self.text}\""
+
+
+def make_token(source: Source, kind: TokenKind, begin: int, end: int) -> Token:
+    text = "<eof>" if kind == EofKind.Eof else source.text[begin:end]
+    return Token(text, kind, Location(source, begin, end))
+
+
+class TokenStore:
+    '''
+    Tokens of a source stored as parallel columns of kind ids and spans.
+    Token objects are views created only when a token is accessed.
+    '''
+    def __init__(self, source: Source):
+        self.source = source
+        self.kinds = array('i')
+        self.begins = array('i')
+        self.ends = array('i')
+
+    def append(self, kind: TokenKind, begin: int, end: int):
+        self.kinds.append(KIND_IDS[kind])
+        self.begins.append(begin)
+        self.ends.append(end)
+
+    def extend(self, other: 'TokenStore'):
+        self.kinds.extend(other.kinds)
+        self.begins.extend(other.begins)
+        self.ends.extend(other.ends)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index: int) -> Token:
+        return make_token(self.source, KINDS[self.kinds[index]], self.begins[index], self.ends[index])
+
+    def __iter__(self) -> Iterator[Token]:
+        return map(self.__getitem__, range(len(self)))
+
+    def __repr__(self):
+        return repr(list(self))
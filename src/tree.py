@@ -3,34 +3,81 @@ from typing import *
 
 from dataclasses import dataclass
 from enum import Enum, auto
+from types import MethodType
 
 from source import Location
 from tokens import Token
 import ast
 
 def buildable(cls):
-    fields = cls.__annotations__
+    fields = list(cls.__annotations__)
     class Builder:
+        __slots__ = ('values',)
+
         def __init__(self):
-            self.values = {field : None for field in fields}
+            self.values = [None] * len(fields)
 
         def build(self, location: Location):
-            obj = cls(*self.values.values())
+            obj = cls(*self.values)
             obj.location = location
             return obj
 
-    def add_builder_method(name):
+    def add_builder_method(name, index):
         def set_field(self, value):
-            self.values[name] = value
+            self.values[index] = value
         setattr(Builder, name, set_field)
 
-    for name in cls.__annotations__:
-        add_builder_method(name)
+    for index, name in enumerate(fields):
+        add_builder_method(name, index)
 
     cls.Builder = Builder
     return cls
 
 
+class node_dispatch:
+    '''
+    Function or method dispatching on the class of the node it is called with,
+    like functools.singledispatchmethod. Implementations are registered for node classes,
+    the decorated function handles nodes of all other classes.
+    Implementations found for a class are cached, so a call costs a single dict lookup.
+    '''
+    def __init__(self, default):
+        self.default = default
+        self.registry = {}
+        self.implementations = implementations = {}
+        dispatch = self.dispatch
+
+        # a plain function, so calling a bound method of it costs a single call
+        def call_method(obj, node, *args):
+            implementation = implementations.get(type(node)) or dispatch(type(node))
+            return implementation(obj, node, *args)
+        self.call_method = call_method
+
+    def register(self, *classes):
+        def register_implementation(implementation):
+            for cls in classes:
+                self.registry[cls] = implementation
+            self.implementations.clear()
+            return implementation
+        return register_implementation
+
+    def dispatch(self, cls):
+        implementation = self.implementations.get(cls)
+        if implementation is None:
+            implementation = next((self.registry[base] for base in cls.__mro__ if base in self.registry), self.default)
+            self.implementations[cls] = implementation
+        return implementation
+
+    def __call__(self, node, *args):
+        implementation = self.implementations.get(type(node)) or self.dispatch(type(node))
+        return implementation(node, *args)
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return MethodType(self.call_method, obj)
+
+
 
 type TypeNode = DisTypeNode | FunctionTypeNode | WildcardTypeNode | VoidTypeNode
 
@@ -175,7 +222,14 @@ class FitStatementNode(Node):
 
 
 type ExprNode = FitExprNode | VarNode | ValueNode | CallNode | AssignNode
-type StatementNode = ExprNode | RetNode | BlockNode | FitStatementNode
+type StatementNode = ExprNode | RetNode | BlockNode | FitStatementNode | ErrorNode
+
+@dataclass
+class ErrorNode(Node):
+    '''
+    Placeholder for tokens skipped while recovering from a syntax error
+    '''
+    pass
 
 @buildable
 @dataclass
@@ -2,25 +2,36 @@ from __future__ import annotations
 from typechecking.types import *
 from tree import GenericParamsNode
 
-class TypingContextFrame:
+class ScopedMap:
+    '''
+    Map from names to values in nested scopes.
+    Each name maps to a stack of its bindings, innermost last,
+    and each scope logs names bound in it, so leaving a scope unbinds only them.
+    '''
     def __init__(self):
-        self.locals = {}
-        self.generic_nums_ctx = {}
+        self.bindings = {}
+        self.scopes = [[]]
 
-    def add_local_var(self, name: str, ty: Ty):
-        self.locals[name] = ty
+    def push(self):
+        self.scopes.append([])
 
-    def has_local_var(self, name: str) -> bool:
-        return name in self.locals
+    def pop(self):
+        for name in self.scopes.pop():
+            bindings = self.bindings[name]
+            bindings.pop()
+            if not bindings:
+                del self.bindings[name]
 
-    def get_local_var_type(self, name: str) -> Ty:
-        return self.locals[name]
+    def add(self, name, value):
+        self.bindings.setdefault(name, []).append(value)
+        self.scopes[-1].append(name)
 
-    def has_generic(self, name):
-        return name in self.generic_nums_ctx
+    def __contains__(self, name) -> bool:
+        return name in self.bindings
 
-    def get_generic(self, name):
-        return self.generic_nums_ctx[name]
+    def get(self, name, default=None):
+        bindings = self.bindings.get(name)
+        return bindings[-1] if bindings else default
 
 
 class TypingContext:
@@ -32,25 +43,23 @@ class TypingContext:
         self.simple_types = {}
         self.current_function_node = None
         self.current_function_ty = None
-        self.stack = [TypingContextFrame()]
+        self.locals = ScopedMap()
+        self.generic_nums = ScopedMap()
+        self.instantiations = InstantiationCache()
 
     def push(self):
-        self.stack.append(TypingContextFrame())
+        self.locals.push()
+        self.generic_nums.push()
 
     def pop(self):
-        self.stack.pop()
+        self.locals.pop()
+        self.generic_nums.pop()
 
     def has_generic(self, name) -> bool:
-        for frame in self.stack[::-1]:
-            if frame.has_generic(name):
-                return True
-        return False
+        return name in self.generic_nums
 
     def get_generic(self, name):
-        for frame in self.stack[::-1]:
-            if frame.has_generic(name):
-                return frame.get_generic(name)
-        return False
+        return self.generic_nums.get(name, False)
 
 
     def has_dis(self, name) -> bool:
@@ -66,19 +75,14 @@ class TypingContext:
         return self.functions[name]
 
     def add_local_var(self, name: str, ty: Ty):
-        self.stack[-1].locals[name] = ty
+        self.locals.add(name, ty)
 
     def has_local_var(self, name: str) -> bool:
-        for frame in self.stack[::-1]:
-            if frame.has_local_var(name):
-                return True
-        return False
+        return name in self.locals
 
     def get_local_var_type(self, name: str) -> Ty:
-        for frame in self.stack[::-1]:
-            if frame.has_local_var(name):
-                return frame.get_local_var_type(name)
+        return self.locals.get(name)
 
     def add_generics(self, generics: GenericParamsNode):
         for i, name in enumerate(generics.params):
-            self.stack[-1].generic_nums_ctx[name.text] = i
+            self.generic_nums.add(name.text, i)
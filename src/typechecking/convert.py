@@ -13,20 +13,19 @@ class TypeConverter:
         self.report = report
         self.ctx = ctx
 
+    @node_dispatch
     def convert_type(self, parsed_type: TypeNode):
-        if isinstance(parsed_type, DisTypeNode):
-            return self.convert_dis_type(parsed_type)
-        elif isinstance(parsed_type, FunctionTypeNode):
-            return self.convert_function_type(parsed_type)
-        elif isinstance(parsed_type, DisConstructorNode):
-            return self.convert_dis_constructor_type(parsed_type)
-        elif isinstance(parsed_type, WildcardTypeNode):
-            return WildcardTy()
-        elif isinstance(parsed_type, VoidTypeNode):
-            return SimpleType('Void')
-        else:
-            raise Exception(f"Cannot convert {parsed_type} into Ty")
+        raise Exception(f"Cannot convert {parsed_type} into Ty")
+
+    @convert_type.register(WildcardTypeNode)
+    def convert_wildcard_type(self, parsed_type: WildcardTypeNode):
+        return WildcardTy()
+
+    @convert_type.register(VoidTypeNode)
+    def convert_void_type(self, parsed_type: VoidTypeNode):
+        return SimpleType('Void')
 
+    @convert_type.register(DisTypeNode)
     def convert_dis_type(self, parsed_type: DisTypeNode):
         name = parsed_type.name.text
         if self.ctx.has_generic(name):
@@ -60,6 +59,7 @@ class TypeConverter:
             self.report.error(Error(msg))
             return ErrorTy()
 
+    @convert_type.register(FunctionTypeNode)
     def convert_function_type(self, parsed_type: FunctionTypeNode):
         arg_types = [self.convert_type(arg) for arg in parsed_type.args]
         ret_type = self.convert_type(parsed_type.ret)
@@ -67,6 +67,7 @@ class TypeConverter:
             return ErrorTy()
         return FunTy(arg_types, ret_type)
 
+    @convert_type.register(DisConstructorNode)
     def convert_dis_constructor_type(self, parsed_type: DisConstructorNode):
         dis_name = parsed_type.name.text
 
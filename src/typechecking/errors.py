@@ -108,6 +108,10 @@ def shadowing_branch_patterns(first_loc: Location, first_pat, second_loc: Locati
     comment = Message(second_loc, f"{second_pat} is used here. Consider changing order of the branches.")
     return Error(reason, [comment])
 
+def unreachable_branch_pattern(location: Location, pat):
+    reason = Message(location, f"Pattern {pat} is unreachable, previous branches cover all its values.")
+    return Error(reason)
+
 
 def expected_dis_type(location: Location, found):
     msg = Message(location, f"Expected dis type, got {found}")
@@ -1,131 +1,151 @@
-from enum import Enum, auto
-from dataclasses import dataclass
-
 from tree import *
 from error_reporting import *
 
 from typechecking.convert import *
+from typechecking.errors import *
+from typechecking.subtyping import is_subpattern
 
-class ExhaustivenessStatus(Enum):
-    All = auto()
-    Missing = auto()
-
-@dataclass
-class ExhaustivenessResult:
-    status: ExhaustivenessStatus
-    missing: TyPattern | None
-
-    def All():
-        return ExhaustivenessResult(ExhaustivenessStatus.All, None)
-
-    def Missing(missing):
-        return ExhaustivenessResult(ExhaustivenessStatus.Missing, missing)
-
+# Rows of a pattern matrix and the vectors checked against them are tuples of patterns
+type PatternRow = Tuple[TyPattern | CatchallPattern, ...]
 
+CATCHALL = CatchallPattern()
 
 
 class ExhaustivenessChecker:
+    '''
+    Checks fit branches with the pattern matrix algorithm from
+    Maranget's "Warnings for pattern matching".
+
+    A pattern row is useful with respect to a matrix if some value matches
+    the row but no row of the matrix. A branch is redundant when its pattern
+    is not useful with respect to the branches above it, and a fit is
+    exhaustive when the catchall is not useful with respect to all branches.
+    Usefulness also yields a witness - a value missed by the matrix.
+    '''
     def __init__(self, report, ctx: TypingContext):
         self.report = report
         self.ctx = ctx
         self.type_converter = TypeConverter(report, ctx)
 
-    def check_fit_exhaustiveness(self, fit: FitExprNode, expr_ty: Ty):
+    def check_fit(self, fit: FitExprNode | FitStatementNode, expr_ty: Ty, check_exhaustiveness: bool) -> bool:
+        '''Reports redundant branches and missing values, returns whether some branch patterns are duplicated'''
         patterns = [
             self.type_converter.convert_pattern(branch.left)
             for branch in fit.branches
         ]
-        dis = self.ctx.get_dis(expr_ty.name)
-        result = self.check_patterns_exhaust_dis(dis, expr_ty.generic_types, patterns)
-
-        if result.status == ExhaustivenessStatus.Missing:
-            self.report.error(fit_is_not_exhaustive(fit, result.missing))
-
-    def check_patterns_exhaust_type(self, ty, patterns):
-        if isinstance(ty, FunTy):
-            if len(patterns) == 0:
-                return ExhaustivenessResult.Missing(CatchallPattern())
-            else:
-                return ExhaustivenessResult.All()
-        elif isinstance(ty, DisTy):
-            decl = self.ctx.get_dis(ty.name)
-            return self.check_patterns_exhaust_dis(decl, ty.generic_types, patterns)
-        elif isinstance(ty, SimpleType) or isinstance(ty, TyVar):
-            if self.patterns_contain_catchall(patterns):
-                return ExhaustivenessResult.All()
-            else:
-                return ExhaustivenessResult.Missing(CatchallPattern())
-        else:
-            raise Exception("Unexpected type: ", ty)
-
-    def patterns_contain_catchall(self, patterns):
-        return any(isinstance(p, CatchallPattern) for p in patterns)
-
-    def check_patterns_exhaust_dis(self, dis: DisDeclaration, generics, patterns: List[TyPattern]):
-        if any(isinstance(pat, CatchallPattern) for pat in patterns):
-            return ExhaustivenessResult.All()
-        else:
-            variants = {
-                v.name: (v, [])
-                for v in dis.variants
-            }
-            for pat in patterns:
-                variants[pat.name][1].append(pat)
-
-            for _, (v, patterns) in variants.items():
-                result = self.check_patterns_exhaust_variant(v, generics, patterns)
-                if result.status == ExhaustivenessStatus.Missing:
-                    return result
-            return ExhaustivenessResult.All()
-
-    def check_patterns_exhaust_variant(self, variant: VariantDeclaration, generics, patterns: List[TyPattern]):
-        if len(patterns) == 0:
-            pat = TyPattern(variant.name, [CatchallPattern() for _ in variant.args])
-            return ExhaustivenessResult.Missing(pat)
-        else:
-            result = self.check_patterns_exhaust_variant_args(variant.args, generics, patterns, 0, [])
-            if result.status == ExhaustivenessStatus.All:
-                return result
+        types = (expr_ty,)
+
+        rows = []
+        redundant = []
+        for j, pattern in enumerate(patterns):
+            if self.useful(rows, (pattern,), types) is None:
+                redundant.append(j)
+            rows.append((pattern,))
+
+        duplicated = self.report_redundant(fit, patterns, redundant)
+
+        if check_exhaustiveness:
+            missing = self.useful(rows, (CATCHALL,), types)
+            if missing is not None:
+                self.report.error(fit_is_not_exhaustive(fit, missing[0]))
+        return duplicated
+
+    def report_redundant(self, fit, patterns, redundant: List[int]) -> bool:
+        '''
+        Redundant branches are explained by earlier branches covering them on their own.
+        Branches covered only by several branches together are reported as unreachable.
+        Returns whether some branches are duplicates of earlier ones.
+        '''
+        duplicated = False
+        covering = []
+        uncovered = []
+        for j in redundant:
+            pairs = [(i, j) for i in range(j) if is_subpattern(patterns[j], patterns[i])]
+            covering += pairs
+            if not pairs:
+                uncovered.append(j)
+
+        for i, j in sorted(covering):
+            if patterns[i] == patterns[j]:
+                err = duplicated_branch_patterns(
+                    fit.branches[j].left.location,
+                    patterns[i],
+                    fit.branches[i].left.location)
+                self.report.error(err)
+                duplicated = True
             else:
-                missing = TyPattern(variant.name, result.missing)
-                return ExhaustivenessResult.Missing(missing)
-
-
-
-    def check_patterns_exhaust_variant_args(self, args, generics, patterns: List[TyPattern], index, current_pattern):
-        if index >= len(args):
-            return ExhaustivenessResult.All()
-        elif len(patterns) == 0:
-            missing = current_pattern + [args[0]] + [CatchallPattern() for _ in range(index + 1, len(args))]
-            return ExhaustivenessResult.Missing(args[0])
-
-        arg = args[index].ty
-        arg = substitute(arg, generics)
-
-        arg_pats = [pattern.children[index] for pattern in patterns]
-
-        arg_cov = self.check_patterns_exhaust_type(arg, self.exclude_catchall(arg_pats))
-
-        if arg_cov.status == ExhaustivenessStatus.All:
-            grouped = { pat: [] for pat in arg_pats if not isinstance(pat, CatchallPattern)}
-            catchall = [pattern for pattern in patterns if isinstance(pattern.children[index], CatchallPattern)]
-            for pat in patterns:
-                if not isinstance(pat.children[index], CatchallPattern):
-                    grouped[pat.children[index]].append(pat)
-            for p, pats in grouped.items():
-                pats = pats + catchall
-                result = self.check_patterns_exhaust_variant_args(args, generics, pats, index + 1, current_pattern + [p])
-                if result.status == ExhaustivenessStatus.Missing:
-                    return result
-            return ExhaustivenessResult.All()
-        else:
-            new_patterns = [pattern for pattern in patterns if isinstance(pattern.children[index], CatchallPattern)]
-            if len(new_patterns) == 0:
-                missing = current_pattern + [arg_cov.missing] + [CatchallPattern() for _ in range(index + 1, len(args))]
-                return ExhaustivenessResult.Missing(missing)
-            else:
-                return self.check_patterns_exhaust_variant_args(args, generics, new_patterns, index + 1, current_pattern + [CatchallPattern()])
-
-
-    def exclude_catchall(self, patterns: List[TyPattern]):
-        return [pat for pat in patterns if not isinstance(pat, CatchallPattern)]
+                err = shadowing_branch_patterns(
+                    fit.branches[i].left.location,
+                    patterns[i],
+                    fit.branches[j].left.location,
+                    patterns[j],
+                )
+                self.report.warning(err)
+
+        for j in uncovered:
+            self.report.warning(unreachable_branch_pattern(fit.branches[j].left.location, patterns[j]))
+        return duplicated
+
+    def useful(self, rows: List[PatternRow], row: PatternRow, types: Tuple[Ty, ...]) -> PatternRow | None:
+        '''
+        Returns a row of patterns matched by `row` and by no row of `rows`,
+        or None if every value matched by `row` is matched by `rows`.
+        '''
+        if not row:
+            return None if rows else ()
+
+        head, ty, rest = row[0], types[0], types[1:]
+        dis = self.ctx.get_dis(ty.name) if isinstance(ty, DisTy) else None
+        variants = dis.variants if dis is not None else ()
+
+        if isinstance(head, TyPattern):
+            variant = dis.get_variant(head.name)
+            witness = self.useful(
+                self.specialize(rows, head.name, len(variant.args)),
+                head.children + row[1:],
+                self.variant_arg_types(ty, variant) + rest)
+            return self.rebuild(head.name, len(variant.args), witness)
+
+        heads = {r[0].name for r in rows if isinstance(r[0], TyPattern)}
+        if variants and len(heads) == len(dis.variant_ids):
+            for variant in variants:
+                name, arity = variant.name, len(variant.args)
+                witness = self.useful(
+                    self.specialize(rows, name, arity),
+                    (CATCHALL,) * arity + row[1:],
+                    self.variant_arg_types(ty, variant) + rest)
+                if witness is not None:
+                    return self.rebuild(name, arity, witness)
+            return None
+
+        witness = self.useful(self.default(rows), row[1:], rest)
+        if witness is None:
+            return None
+        if not heads:
+            return (CATCHALL,) + witness
+        for variant in variants:
+            if variant.name not in heads:
+                return (TyPattern(variant.name, (CATCHALL,) * len(variant.args)),) + witness
+
+    def variant_arg_types(self, ty: DisTy, variant: VariantDeclaration) -> Tuple[Ty, ...]:
+        return self.ctx.instantiations.variant_arg_types(ty.name, variant, ty.generic_types)
+
+    def specialize(self, rows: List[PatternRow], name: str, arity: int) -> List[PatternRow]:
+        '''Rows matching variant `name`, with its arguments in place of the first column'''
+        result = []
+        for row in rows:
+            head = row[0]
+            if isinstance(head, CatchallPattern):
+                result.append((CATCHALL,) * arity + row[1:])
+            elif head.name == name:
+                result.append(head.children + row[1:])
+        return result
+
+    def default(self, rows: List[PatternRow]) -> List[PatternRow]:
+        '''Rows matching variants absent from the first column'''
+        return [row[1:] for row in rows if isinstance(row[0], CatchallPattern)]
+
+    def rebuild(self, name: str, arity: int, witness: PatternRow | None) -> PatternRow | None:
+        if witness is None:
+            return None
+        return (TyPattern(name, witness[:arity]),) + witness[arity:]
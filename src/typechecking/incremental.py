@@ -0,0 +1,275 @@
+import hashlib
+import json
+import pickle
+from dataclasses import dataclass
+
+from tree import *
+from error_reporting import Error, Message
+from typechecking.types import *
+
+# Bumped whenever typechecking results for the same sources may change
+CACHE_VERSION = 2
+
+# Dependency of a function body: kind of lookup and the name looked up
+type Dependency = Tuple[str, str]
+
+# Location relative to the beginning of an item, the key of the item is None for the checked function itself
+type RelativeLocation = Tuple[Tuple[str, str, int] | None, int, int]
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@dataclass
+class FunctionEntry:
+    '''
+    Result of typechecking a function body, together with fingerprints
+    of declarations it looked up. It is valid for every function with the same
+    text as long as those declarations have the same fingerprints.
+    Annotations are None if the function was checked without annotating types.
+    '''
+    dependencies: Dict[Dependency, str | None]
+    errors: List[Tuple[Tuple[RelativeLocation, str], List[Tuple[RelativeLocation, str]] | None]]
+    warnings: List[Tuple[Tuple[RelativeLocation, str], List[Tuple[RelativeLocation, str]] | None]]
+    annotations: List[Tuple[int, Any]] | None
+
+    def to_json(self):
+        return {
+            'dependencies': [[kind, name, fingerprint] for (kind, name), fingerprint in self.dependencies.items()],
+            'errors': self.errors,
+            'warnings': self.warnings,
+            'annotations': None if self.annotations is None else [[j, type_descriptor(ty)] for j, ty in self.annotations],
+        }
+
+    def from_json(data) -> 'FunctionEntry':
+        return FunctionEntry(
+            {(kind, name): fingerprint for kind, name, fingerprint in data['dependencies']},
+            diagnostics_from_json(data['errors']),
+            diagnostics_from_json(data['warnings']),
+            None if data['annotations'] is None else [(j, type_from_descriptor(d)) for j, d in data['annotations']],
+        )
+
+
+def diagnostics_from_json(diagnostics):
+    '''Relative errors or warnings read from JSON, with item keys as tuples again'''
+    def message(data):
+        (key, begin, end), comment = data
+        return ((None if key is None else tuple(key), begin, end), comment)
+    return [(message(reason), None if messages is None else [message(m) for m in messages]) for reason, messages in diagnostics]
+
+
+def type_descriptor(ty: Ty):
+    '''Describes a type with JSON values, types are rebuilt by type_from_descriptor'''
+    if ty is None:
+        return None
+    if isinstance(ty, ErrorTy):
+        return ['error']
+    if isinstance(ty, WildcardTy):
+        return ['wildcard']
+    if isinstance(ty, TyVar):
+        return ['var', ty.index, ty.name]
+    if isinstance(ty, SimpleType):
+        return ['simple', ty.name]
+    if isinstance(ty, FunTy):
+        return ['fun', [type_descriptor(arg) for arg in ty.arg_types], type_descriptor(ty.result_type)]
+    if isinstance(ty, DisTy):
+        return ['dis', ty.name, [type_descriptor(generic) for generic in ty.generic_types], pattern_descriptor(ty.pattern)]
+    raise TypeError(f"cannot describe type {ty!r}")
+
+
+def pattern_descriptor(pattern: TyPattern | CatchallPattern):
+    if isinstance(pattern, CatchallPattern):
+        return None
+    children = None if pattern.children is None else [pattern_descriptor(child) for child in pattern.children]
+    return [pattern.name, children]
+
+
+def type_from_descriptor(descriptor) -> Ty:
+    if descriptor is None:
+        return None
+    kind, *fields = descriptor
+    if kind == 'error':
+        return ErrorTy()
+    if kind == 'wildcard':
+        return WildcardTy()
+    if kind == 'var':
+        index, name = fields
+        return TyVar(index, name)
+    if kind == 'simple':
+        name, = fields
+        return SimpleType(name)
+    if kind == 'fun':
+        arg_types, result_type = fields
+        return FunTy([type_from_descriptor(arg) for arg in arg_types], type_from_descriptor(result_type))
+    if kind == 'dis':
+        name, generic_types, pattern = fields
+        return DisTy(name, [type_from_descriptor(generic) for generic in generic_types], pattern_from_descriptor(pattern))
+    raise ValueError(f"unknown type descriptor {kind!r}")
+
+
+def pattern_from_descriptor(descriptor) -> TyPattern | CatchallPattern:
+    if descriptor is None:
+        return CatchallPattern()
+    name, children = descriptor
+    return TyPattern(name, None if children is None else [pattern_from_descriptor(child) for child in children])
+
+
+class TypecheckCache:
+    '''
+    Typechecking results of function bodies from the previous run, keyed by hash of function text.
+    Entries of functions not present in the current run are dropped when saving.
+    The cache is stored as JSON, so reading a cache file never runs code from it.
+    '''
+    def __init__(self, path: str, functions: Dict[str, FunctionEntry] | None = None):
+        self.path = path
+        self.functions = functions or {}
+        self.current = {}
+        self.checked = 0
+        self.replayed = 0
+
+    def load(path: str) -> 'TypecheckCache':
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data['version'] == CACHE_VERSION:
+                functions = {key: FunctionEntry.from_json(entry) for key, entry in data['functions'].items()}
+                return TypecheckCache(path, functions)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        return TypecheckCache(path)
+
+    def save(self):
+        functions = {key: entry.to_json() for key, entry in self.current.items()}
+        with open(self.path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'functions': functions}, f)
+
+    def __str__(self):
+        return f"typecheck cache: {self.checked} functions checked, {self.replayed} replayed"
+
+
+class DependencyRecorder:
+    '''
+    Records declarations looked up while typechecking a function body.
+    Each lookup is stored with a fingerprint of what was found, so the result
+    can be reused in a later run if the same lookups find the same declarations.
+    '''
+    def __init__(self):
+        self.dependencies = None
+        self.fingerprints = {}
+        self.tables = {}
+
+    def record(self, kind: str, name: str):
+        if self.dependencies is not None:
+            self.dependencies[(kind, name)] = self.fingerprint(kind, name)
+
+    def fingerprint(self, kind: str, name: str) -> str | None:
+        key = (kind, name)
+        if key not in self.fingerprints:
+            table = self.tables.get(kind)
+            value = None if table is None else dict.get(table, name)
+            if value is None:
+                self.fingerprints[key] = None
+            elif kind.endswith('_node'):
+                # nodes are used in error messages, which are relocated when replayed
+                self.fingerprints[key] = digest("\0".join(node_text(node) for node in value).encode())
+            else:
+                self.fingerprints[key] = digest(pickle.dumps(value))
+        return self.fingerprints[key]
+
+    def is_valid(self, entry: FunctionEntry) -> bool:
+        return all(
+            self.fingerprint(kind, name) == fingerprint
+            for (kind, name), fingerprint in entry.dependencies.items()
+        )
+
+
+class RecordingDict(dict):
+    '''Declaration table reporting every lookup to a DependencyRecorder'''
+    def __init__(self, kind: str, recorder: DependencyRecorder, table: Dict):
+        super().__init__(table)
+        self.kind = kind
+        self.recorder = recorder
+        recorder.tables[kind] = self
+
+    def __getitem__(self, name):
+        self.recorder.record(self.kind, name)
+        return super().__getitem__(name)
+
+    def __contains__(self, name):
+        self.recorder.record(self.kind, name)
+        return super().__contains__(name)
+
+    def get(self, name, default=None):
+        self.recorder.record(self.kind, name)
+        return super().get(name, default)
+
+
+def node_text(node: Node) -> str:
+    return node.location.source.text[node.location.begin:node.location.end]
+
+
+class ItemLocator:
+    '''
+    Converts locations of diagnostics to positions relative to program items and back.
+    Items are identified by kind, name and occurrence of the name,
+    so diagnostics stay valid when items move within the source.
+    '''
+    def __init__(self, program: ProgramNode):
+        self.keys = {}
+        occurrences = {}
+        for item in program.items:
+            if isinstance(item, (FunNode, DisNode)):
+                kind = 'fun' if isinstance(item, FunNode) else 'dis'
+                name = item.name.text
+                occurrence = occurrences.get((kind, name), 0)
+                occurrences[(kind, name)] = occurrence + 1
+                self.keys[(kind, name, occurrence)] = item
+
+    def relative(self, location: Location, fun: FunNode) -> RelativeLocation | None:
+        if fun.location.begin <= location.begin and location.end <= fun.location.end:
+            return (None, location.begin - fun.location.begin, location.end - fun.location.begin)
+        for key, item in self.keys.items():
+            if item.location.begin <= location.begin and location.end <= item.location.end:
+                return (key, location.begin - item.location.begin, location.end - item.location.begin)
+        return None
+
+    def absolute(self, location: RelativeLocation, fun: FunNode) -> Location | None:
+        key, begin, end = location
+        item = fun if key is None else self.keys.get(key)
+        if item is None:
+            return None
+        return Location(item.location.source, item.location.begin + begin, item.location.begin + end)
+
+    def relative_errors(self, errors: List[Error], fun: FunNode):
+        '''Returns errors with relative locations or None if some location is outside of items'''
+        result = []
+        for error in errors:
+            reason = self.relative_message(error.reason, fun)
+            messages = None
+            if error.messages is not None:
+                messages = [self.relative_message(message, fun) for message in error.messages]
+            if reason is None or (messages is not None and None in messages):
+                return None
+            result.append((reason, messages))
+        return result
+
+    def relative_message(self, message: Message, fun: FunNode):
+        location = self.relative(message.location, fun)
+        return None if location is None else (location, message.comment)
+
+    def absolute_errors(self, errors, fun: FunNode) -> List[Error] | None:
+        result = []
+        for reason, messages in errors:
+            reason = self.absolute_message(reason, fun)
+            if messages is not None:
+                messages = [self.absolute_message(message, fun) for message in messages]
+            if reason is None or (messages is not None and None in messages):
+                return None
+            result.append(Error(reason, messages))
+        return result
+
+    def absolute_message(self, message, fun: FunNode) -> Message | None:
+        location, comment = message
+        location = self.absolute(location, fun)
+        return None if location is None else Message(location, comment)
@@ -34,7 +34,7 @@ def find_supertype(t1: Ty, t2: Ty) -> Ty:
         return ErrorTy()
     elif isinstance(t1, DisTy) and isinstance(t2, DisTy):
         if t1.name == t2.name and t1.generic_types == t2.generic_types:
-            return DisTy(t1.name, t1.generic_types, find_superpattern(t1.pattern, t2.pattern))
+            return t1.with_pattern(find_superpattern(t1.pattern, t2.pattern))
         else:
             return ErrorTy()
     else:
@@ -1,6 +1,6 @@
 from typing import *
+from concurrent.futures import ProcessPoolExecutor
 from tree import *
-from copy import deepcopy
 from error_reporting import *
 
 from parsing.expressions import TOKENS_BUILTINS_MAP
@@ -13,6 +13,7 @@ from typechecking.context import *
 from typechecking.convert import *
 from typechecking.errors import *
 from typechecking.exhaustiveness import *
+from typechecking.incremental import *
 
 def get_simple_types():
     return {
@@ -30,54 +31,204 @@ def get_builtins():
         '__builtin_operator_less' : FunctionDeclaration(1, FunTy([INT, INT, TY, TY], TY))
     }
 
-def typecheck(program):
-    typechecker = Typechecker(get_simple_types(), get_builtins())
-    typechecker.typecheck(program)
+def typecheck(program, workers=None, cache: TypecheckCache | None = None, annotate_types: bool = True):
+    '''
+    Typechecks the program, with function bodies split between
+    the given number of worker processes if workers is not None.
+    If a cache is given, function bodies are checked incrementally instead.
+    Expressions are annotated with their types for to_ll unless annotate_types is False,
+    which is enough when only diagnostics are needed.
+    '''
+    typechecker = Typechecker(get_simple_types(), get_builtins(), annotate_types)
+    typechecker.typecheck_program(program, workers, cache)
     return typechecker.ctx, typechecker.report
 
 
+# Typechecker with declarations already found and the program, set up once per worker process
+WORKER_STATE = None
+
+def init_worker(typechecker, program):
+    global WORKER_STATE
+    WORKER_STATE = (typechecker, program)
+
+def typecheck_functions(indices: List[int]):
+    '''
+    Typechecks functions at the given indices of program items in a worker.
+    Returns types of expressions in each function and diagnostics found in them.
+    '''
+    typechecker, program = WORKER_STATE
+    report = typechecker.report
+    report.errors.clear()
+    report.warnings.clear()
+    annotations = []
+    for i in indices:
+        typechecker.typecheck(program.items[i])
+        annotations.append(type_annotations(program.items[i]) if typechecker.annotate_types else [])
+    return annotations, report.errors, report.warnings
+
+
+# Fields holding nodes the typechecker may annotate with types, other fields are never annotated
+TYPED_CHILDREN = {
+    FunNode: ('body',),
+    BlockNode: ('statements',),
+    RetNode: ('expr',),
+    LetNode: ('value',),
+    FitExprNode: ('expr', 'branches'),
+    FitStatementNode: ('expr', 'branches'),
+    FitBranchNode: ('right',),
+    CallNode: ('fun', 'arguments'),
+    AssignNode: ('var', 'expr'),
+    MemberNode: ('expr',),
+}
+
+def typed_nodes(node, nodes=None):
+    '''Nodes that may be annotated with types, in the same order in every process'''
+    if nodes is None:
+        nodes = []
+    nodes.append(node)
+    for field in TYPED_CHILDREN.get(type(node), ()):
+        child = getattr(node, field)
+        if type(child) is list:
+            for grandchild in child:
+                typed_nodes(grandchild, nodes)
+        elif child is not None:
+            typed_nodes(child, nodes)
+    return nodes
+
+def type_annotations(fun: FunNode) -> List[Tuple[int, Ty]]:
+    '''Types of expressions in a typechecked function, with their positions in typed_nodes'''
+    return [(j, node.ty) for j, node in enumerate(typed_nodes(fun)) if hasattr(node, 'ty')]
+
+def annotate(fun: FunNode, annotations: List[Tuple[int, Ty]]):
+    nodes = typed_nodes(fun)
+    for j, ty in annotations:
+        nodes[j].ty = ty
+
+
 class Typechecker:
-    def __init__(self, simple_types, bultins):
+    def __init__(self, simple_types, bultins, annotate_types: bool = True):
         self.ctx = TypingContext()
         self.ctx.simple_types = simple_types
         self.ctx.functions = bultins
         self.report = ErrorReport()
         self.type_converter = TypeConverter(self.report, self.ctx)
         self.exhausiveness_checker = ExhaustivenessChecker(self.report, self.ctx)
+        self.annotate_types = annotate_types
 
+    @node_dispatch
     def typecheck(self, tree):
-        if isinstance(tree, ProgramNode):
-            self.typecheck_program(tree)
-        elif isinstance(tree, Write):
-            return
-        elif isinstance(tree, FitExprNode) or isinstance(tree, FitStatementNode):
-            self.type_fit(tree)
-        elif isinstance(tree, LetNode):
-            ty = self.type_expr(tree.value)
-            self.ctx.add_local_var(tree.name.text, ty)
-        elif isinstance(tree, CallNode):
-            self.type_call(tree)
-        elif isinstance(tree, DisNode):
-            pass
-        elif isinstance(tree, FunNode):
-            self.type_fun(tree)
-        elif isinstance(tree, BlockNode):
-            self.ctx.push()
-            for statement in tree.statements:
-                self.typecheck(statement)
-            self.ctx.pop()
-        elif isinstance(tree, RetNode):
-            self.type_ret(tree)
-        else:
-            self.type_expr(tree)
+        self.type_expr(tree)
+
+    def type_expr(self, expr: ExprNode):
+        ty = self.expr_type(expr)
+        if self.annotate_types:
+            expr.ty = ty
+        return ty
+
+    @node_dispatch
+    def expr_type(self, expr: ExprNode):
+        raise Exception(f"Cannot get type of expression {expr}")
+
+    @typecheck.register(Write, ErrorNode, DisNode)
+    def skip(self, tree):
+        pass
+
+    @typecheck.register(BlockNode)
+    def type_block(self, block: BlockNode):
+        self.ctx.push()
+        for statement in block.statements:
+            self.typecheck(statement)
+        self.ctx.pop()
 
-    def typecheck_program(self, program: ProgramNode):
+    @typecheck.register(ProgramNode)
+    def typecheck_program(self, program: ProgramNode, workers=None, cache: TypecheckCache | None = None):
         self.ctx.dises = self.find_dis_declarations(program)
         self.ctx.functions |= self.find_function_declarations(program)
 
-        for item in program.items:
-            self.typecheck(item)
+        # cached results are replayed into this process, so workers are not used with a cache
+        if cache is not None:
+            self.typecheck_functions_incrementally(program, cache)
+        elif workers is None:
+            for item in program.items:
+                self.typecheck(item)
+        else:
+            self.typecheck_functions_in_parallel(program, workers)
+
+    def typecheck_functions_in_parallel(self, program: ProgramNode, workers: int):
+        '''
+        Function bodies are typechecked independently once declarations are known,
+        so contiguous runs of functions are checked in worker processes,
+        which send back types of expressions to annotate the tree with.
+        Other items report nothing, and diagnostics are merged in source order,
+        so the report is the same as when typechecking serially.
+        '''
+        indices = [i for i, item in enumerate(program.items) if isinstance(item, FunNode)]
+        chunk_size = -(-len(indices) // (workers * 4)) or 1
+        chunks = [indices[i:i + chunk_size] for i in range(0, len(indices), chunk_size)]
+
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self, program)) as executor:
+            for chunk, (annotations, errors, warnings) in zip(chunks, executor.map(typecheck_functions, chunks)):
+                for i, types in zip(chunk, annotations):
+                    annotate(program.items[i], types)
+                self.report.errors += errors
+                self.report.warnings += warnings
+
+    def typecheck_functions_incrementally(self, program: ProgramNode, cache: TypecheckCache):
+        '''
+        Declarations are always found anew, function bodies are checked only
+        if their text changed or declarations they looked up changed since the cached run.
+        Types and diagnostics of other functions are replayed from the cache.
+        '''
+        recorder = DependencyRecorder()
+        self.ctx.dises = RecordingDict('dis', recorder, self.ctx.dises)
+        self.ctx.functions = RecordingDict('fun', recorder, self.ctx.functions)
+        self.ctx.fun_nodes = RecordingDict('fun_node', recorder, self.ctx.fun_nodes)
+        self.ctx.dis_nodes = RecordingDict('dis_node', recorder, self.ctx.dis_nodes)
+        self.type_converter.dis_nodes = self.ctx.dis_nodes
+        locator = ItemLocator(program)
 
+        for item in program.items:
+            if not isinstance(item, FunNode):
+                self.typecheck(item)
+                continue
+            key = digest(node_text(item).encode())
+            entry = cache.functions.get(key)
+            if entry is not None and recorder.is_valid(entry) and self.replay(item, entry, locator):
+                cache.replayed += 1
+            else:
+                entry = self.typecheck_recording_dependencies(item, recorder, locator)
+                cache.checked += 1
+            if entry is not None:
+                cache.current[key] = entry
+
+    def replay(self, fun: FunNode, entry: FunctionEntry, locator: ItemLocator) -> bool:
+        errors = locator.absolute_errors(entry.errors, fun)
+        warnings = locator.absolute_errors(entry.warnings, fun)
+        if errors is None or warnings is None:
+            return False
+        if self.annotate_types:
+            if entry.annotations is None:
+                return False
+            annotate(fun, entry.annotations)
+        self.report.errors += errors
+        self.report.warnings += warnings
+        return True
+
+    def typecheck_recording_dependencies(self, fun: FunNode, recorder: DependencyRecorder, locator: ItemLocator):
+        '''Typechecks a function and returns its cache entry, or None if diagnostics cannot be relocated'''
+        first_error, first_warning = len(self.report.errors), len(self.report.warnings)
+        recorder.dependencies = {}
+        self.typecheck(fun)
+        dependencies, recorder.dependencies = recorder.dependencies, None
+
+        errors = locator.relative_errors(self.report.errors[first_error:], fun)
+        warnings = locator.relative_errors(self.report.warnings[first_warning:], fun)
+        if errors is None or warnings is None:
+            return None
+        annotations = type_annotations(fun) if self.annotate_types else None
+        return FunctionEntry(dependencies, errors, warnings, annotations)
+
+    @expr_type.register(VarNode)
     def type_var(self, var: VarNode):
         name = var.name.text
         if self.ctx.has_local_var(name):
@@ -98,11 +249,12 @@ class Typechecker:
             self.report.error(unknown_variable(var))
             return ErrorTy()
 
+    @typecheck.register(LetNode)
     def type_let(self, let: LetNode):
         var_type = self.type_expr(let.value)
-        self.ctx.add_local_var(let.name, var_type)
-        return None
+        self.ctx.add_local_var(let.name.text, var_type)
 
+    @typecheck.register(FunNode)
     def type_fun(self, fun: FunNode):
         fun_ty = self.get_fun_type(fun)
         if isinstance(fun_ty, ErrorTy):
@@ -118,6 +270,7 @@ class Typechecker:
         self.ctx.current_function_node = None
         self.ctx.pop()
 
+    @expr_type.register(FunInstNode)
     def type_function_instantiation(self, fun_inst: FunInstNode):
         name = fun_inst.name.text
         if self.ctx.has_function(name):
@@ -139,6 +292,7 @@ class Typechecker:
             converted_generics.append(converted)
         return converted_generics
 
+    @expr_type.register(ValueNode)
     def type_value(self, expr: ValueNode):
         if isinstance(expr.token.kind, NumberKind):
             return SimpleType('Int')
@@ -147,6 +301,7 @@ class Typechecker:
         else:
             raise Exception(f"Unsupported value type: {type(expr.val)}")
 
+    @expr_type.register(DisConstructorNode)
     def type_dis_constructor(self, expr: DisConstructorNode):
         if not self.ctx.has_dis(expr.name.text):
             self.report.error(dis_does_not_exist(expr.name.location, expr.name.text))
@@ -167,46 +322,18 @@ class Typechecker:
         generics = [self.type_converter.convert_type(generic) for generic in expr.generics]
 
         variant = dis_decl.get_variant(expr.variant_name.text)
-        variant_ty = DisTy(expr.name.text, generics, TyPattern(expr.variant_name.text, None))
-        arg_tys = [substitute(arg.ty, generics) for arg in variant.args]
+        return self.ctx.instantiations.constructor_type(expr.name.text, variant, generics)
 
-        if len(arg_tys) == 0:
-            return variant_ty
-        else:
-            return FunTy(arg_tys, variant_ty)
+    @expr_type.register(Write)
+    def type_write(self, write: Write):
+        return None
 
-    def type_expr(self, expr: ExprNode):
-        if isinstance(expr, FunInstNode):
-            expr.ty = self.type_function_instantiation(expr)
-            return expr.ty
-        elif isinstance(expr, ValueNode):
-            expr.ty = self.type_value(expr)
-            return expr.ty
-        elif isinstance(expr, DisConstructorNode):
-            expr.ty = self.type_dis_constructor(expr)
-            return expr.ty
-        elif isinstance(expr, VarNode):
-            expr.ty = self.type_var(expr)
-            return expr.ty
-        elif isinstance(expr, FitExprNode):
-            expr.ty = self.type_fit(expr)
-            return expr.ty
-        elif isinstance(expr, CallNode):
-            expr.ty = self.type_call(expr)
-            return expr.ty
-        elif isinstance(expr, MemberNode):
-            expr.ty = self.type_member(expr)
-            return expr.ty
-        elif isinstance(expr, Write):
-            expr.ty = None
-            return expr.ty
-        elif isinstance(expr, AssignNode):
-            expr.ty = self.type_expr(expr.var)
-            # todo check if expr.expr has compatible type
-            return expr.ty
-        else:
-            raise Exception(f"Cannot get type of expression {expr}")
+    @expr_type.register(AssignNode)
+    def type_assign(self, assign: AssignNode):
+        # todo check if assign.expr has compatible type
+        return self.type_expr(assign.var)
 
+    @expr_type.register(MemberNode)
     def type_member(self, member: MemberNode):
         expr_ty = self.type_expr(member.expr)
         if isinstance(expr_ty, ErrorTy):
@@ -225,15 +352,19 @@ class Typechecker:
         else:
             dis_decl = self.ctx.get_dis(expr_ty.name)
             variant = dis_decl.get_variant(expr_ty.pattern.name)
-            variant_node = self.ctx.dis_nodes[expr_ty.name][0].get_variant_node(expr_ty.pattern.name)
             if not variant.has_arg(member.member_name.text):
+                dis_node = self.ctx.dis_nodes[expr_ty.name][0]
+                variant_node = dis_node.variants[dis_decl.get_variant_id(expr_ty.pattern.name)]
                 self.report.error(variant_has_no_member(member.location, member.member_name.text, expr_ty, variant_node))
                 return ErrorTy()
-            arg_ty = deepcopy(substitute(variant.get_arg(member.member_name.text).ty, expr_ty.generic_types))
+            arg_index = variant.arg_index(member.member_name.text)
+            arg_ty = self.ctx.instantiations.variant_arg_types(expr_ty.name, variant, expr_ty.generic_types)[arg_index]
             if isinstance(arg_ty, DisTy) and expr_ty.pattern.children:
-                arg_ty.pattern = expr_ty.pattern.children[variant.arg_index(member.member_name.text)]
+                arg_ty = arg_ty.with_pattern(expr_ty.pattern.children[arg_index])
             return arg_ty
 
+    @typecheck.register(FitExprNode, FitStatementNode)
+    @expr_type.register(FitExprNode)
     def type_fit(self, fit: FitExprNode | FitStatementNode):
         expr = fit.expr
         expr_ty = self.type_expr(expr)
@@ -250,11 +381,8 @@ class Typechecker:
         for branch in fit.branches[1:]:
             ty = find_supertype(ty, self.type_fit_branch(expr, expr_ty, branch, is_fit_statement))
 
-        if not isinstance(ty, ErrorTy) and self.are_branch_patterns_duplicated(fit):
+        if not isinstance(ty, ErrorTy) and self.exhausiveness_checker.check_fit(fit, expr_ty, not is_fit_statement):
             ty = ErrorTy()
-
-        if not is_fit_statement and not isinstance(ty, ErrorTy):
-            self.exhausiveness_checker.check_fit_exhaustiveness(fit, expr_ty)
         return ty
 
     def type_fit_branch(self, fit_expr: ExprNode, fit_expr_ty: Ty, branch: FitBranchNode, is_fit_statement):
@@ -267,30 +395,11 @@ class Typechecker:
             return self.type_fit_branch_right(branch.right, is_fit_statement)
         else:
             self.ctx.push()
-            self.ctx.add_local_var(fit_expr.name.text, DisTy(fit_expr_ty.name, fit_expr_ty.generic_types, pat))
+            self.ctx.add_local_var(fit_expr.name.text, fit_expr_ty.with_pattern(pat))
             result = self.type_fit_branch_right(branch.right, is_fit_statement)
             self.ctx.pop()
             return result
 
-    def are_branch_patterns_duplicated(self, fit: FitExprNode | FitStatementNode):
-        patterns = [self.type_converter.convert_pattern(branch.left) for branch in fit.branches]
-        for i in range(len(patterns)):
-            for j in range(i + 1, len(patterns)):
-                if patterns[i] == patterns[j]:
-                    err = duplicated_branch_patterns(
-                        fit.branches[j].left.location,
-                        patterns[i],
-                        fit.branches[i].left.location)
-                    self.report.error(err)
-                elif is_subpattern(patterns[j], patterns[i]):
-                    err = shadowing_branch_patterns(
-                        fit.branches[i].left.location,
-                        patterns[i],
-                        fit.branches[j].left.location,
-                        patterns[j],
-                    )
-                    self.report.warning(err)
-
     def type_fit_branch_right(self, node, is_fit_statement):
         if is_fit_statement:
             self.typecheck(node)
@@ -310,20 +419,22 @@ class Typechecker:
             self.report.error(dis_has_no_variant(pat.location, ty.name, pat.name.text))
             return False
         variant_decl = dis_decl.get_variant(pat.name.text)
-        variant_node = [v for v in dis_node.variants if v.name.text == pat.name.text][0]
         if variant_decl.get_arg_count() != len(pat.args):
+            variant_node = dis_node.variants[dis_decl.get_variant_id(pat.name.text)]
             err = variant_argument_count_mismatch(pat.location, dis_node, variant_node, len(pat.args))
             self.report.error(err)
             return False
 
         ok = True
-        for (arg_ty, child_pattern) in zip(variant_decl.get_arg_types(), pat.args):
-            arg_ty = substitute(arg_ty, ty.generic_types)
+        arg_tys = self.ctx.instantiations.variant_arg_types(ty.name, variant_decl, ty.generic_types)
+        for (arg_ty, child_pattern) in zip(arg_tys, pat.args):
             child_result = self.validate_pattern_valid_for_ty(child_pattern, arg_ty)
             if not child_result:
                 ok = False
         return ok
 
+    @typecheck.register(CallNode)
+    @expr_type.register(CallNode)
     def type_call(self, call: CallNode):
         fun_ty = self.type_expr(call.fun)
         arg_tys = [self.type_expr(arg) for arg in call.arguments]
@@ -355,6 +466,7 @@ class Typechecker:
         else:
             return fun_ty.result_type
 
+    @typecheck.register(RetNode)
     def type_ret(self, node: RetNode):
         fun_ty = self.ctx.current_function_ty
         return_ty = SimpleType('Void') if node.expr is None else self.type_expr(node.expr)
@@ -470,4 +582,4 @@ class Typechecker:
             expected = decl.generic_arg_count
             actual = len(args)
             self.report.error(fun_generic_arguments_mismatch(fun_inst.location, fun_node, expected, actual))
-        return substitute(decl.ty, args)
+        return self.ctx.instantiations.function_type(fun_inst.name.text, decl, args)
@@ -1,27 +1,60 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from tree import TypeNode
 
 type Ty = WildcardTy | TyVar | FunTy | DisTy | ErrorTy | None | SimpleType
 
-@dataclass
-class WildcardTy:
+class InternedTy:
+    '''
+    Immutable, hash-consed type.
+    Constructing a type returns the existing instance equal to it if there is one,
+    so types are compared and hashed by identity.
+    '''
+    __slots__ = ()
+    fields = ()
+    instances = {}
+
+    def __new__(cls, *values):
+        key = (cls, *values)
+        ty = InternedTy.instances.get(key)
+        if ty is None:
+            ty = object.__new__(cls)
+            for field, value in zip(cls.fields, values):
+                object.__setattr__(ty, field, value)
+            InternedTy.instances[key] = ty
+        return ty
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, field) for field in self.fields))
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.fields)
+        return f"{type(self).__name__}({fields})"
+
+class WildcardTy(InternedTy):
+    __slots__ = ()
 
     def __str__(self):
         return "?"
 
-@dataclass
-class TyVar:
-    index: int
-    name: str
+class TyVar(InternedTy):
+    __slots__ = fields = ('index', 'name')
 
     def __str__(self):
         return self.name
 
-@dataclass
-class SimpleType:
-    name: str
+class SimpleType(InternedTy):
+    __slots__ = fields = ('name',)
 
     def __str__(self):
         return self.name
@@ -34,25 +67,40 @@ class FunctionDeclaration:
     generic_arg_count: int
     ty: FunTy
 
+def index_by_name(items) -> Dict[str, int]:
+    '''
+    Maps names of items to their indices, the first item wins for repeated names
+    '''
+    indices = {}
+    for i, item in enumerate(items):
+        indices.setdefault(item.name, i)
+    return indices
+
 @dataclass
 class DisDeclaration:
     generic_arg_count: int
     variants: List[VariantDeclaration]
 
+    def __post_init__(self):
+        self.variant_ids = index_by_name(self.variants)
+
     def has_variant(self, name):
-        return any(variant.name == name for variant in self.variants)
+        return name in self.variant_ids
 
     def get_variant(self, name):
-        return next(variant for variant in self.variants if variant.name == name)
+        return self.variants[self.variant_ids[name]]
 
     def get_variant_id(self, name):
-        return next(i for (i, variant) in enumerate(self.variants) if variant.name == name)
+        return self.variant_ids[name]
 
 @dataclass
 class VariantDeclaration:
     name: str
     args: List[Arg]
 
+    def __post_init__(self):
+        self.arg_ids = index_by_name(self.args)
+
     def get_arg_count(self):
         return len(self.args)
 
@@ -60,23 +108,24 @@ class VariantDeclaration:
         return [arg.ty for arg in self.args]
 
     def has_arg(self, name: str):
-        return any(arg.name == name for arg in self.args)
+        return name in self.arg_ids
 
     def get_arg(self, name: str):
-        return next(arg for arg in self.args if arg.name == name)
+        return self.args[self.arg_ids[name]]
 
     def arg_index(self, name: str):
-        return [arg.name for arg in self.args].index(name)
+        return self.arg_ids[name]
 
 @dataclass
 class Arg:
     name: str
     ty: Ty
 
-@dataclass
-class FunTy:
-    arg_types: List[Ty]
-    result_type: Ty
+class FunTy(InternedTy):
+    __slots__ = fields = ('arg_types', 'result_type')
+
+    def __new__(cls, arg_types: List[Ty], result_type: Ty):
+        return super().__new__(cls, tuple(arg_types), result_type)
 
     def __str__(self) -> str:
         args = [f"{arg}" for arg in self.arg_types ]
@@ -89,9 +138,17 @@ class FunTy:
 
 @dataclass(frozen=True)
 class TyPattern:
+    '''
+    Pattern refining a dis type, kept apart from the types it refines.
+    Children are stored as a tuple, so patterns are hashable.
+    '''
     name: str
     children: Tuple[TyPattern | CatchallPattern] | None
 
+    def __post_init__(self):
+        if isinstance(self.children, list):
+            object.__setattr__(self, 'children', tuple(self.children))
+
     def __str__(self):
         children = ""
         if self.children is not None:
@@ -118,11 +175,14 @@ class CatchallPattern:
     def is_compound(self):
         return False
 
-@dataclass
-class DisTy:
-    name: str
-    generic_types: List[Ty]
-    pattern: TyPattern
+class DisTy(InternedTy):
+    __slots__ = fields = ('name', 'generic_types', 'pattern')
+
+    def __new__(cls, name: str, generic_types: List[Ty], pattern: TyPattern):
+        return super().__new__(cls, name, tuple(generic_types), pattern)
+
+    def with_pattern(self, pattern: TyPattern) -> DisTy:
+        return DisTy(self.name, self.generic_types, pattern)
 
     def __str__(self):
         generics = ", ".join(str(ty) for ty in self.generic_types)
@@ -132,15 +192,68 @@ class DisTy:
         return f"{self.name}{generics}{pattern}"
 
 
+# Results of substitute, keyed by (type, substitution)
+SUBSTITUTIONS = {}
+
 def substitute(ty: Ty, subst: List[Ty]):
-    if isinstance(ty, FunTy):
-        arg_types = [substitute(arg, subst) for arg in ty.arg_types]
-        result_type = substitute(ty.result_type, subst)
-        return FunTy(arg_types, result_type)
-    elif isinstance(ty, DisTy):
-        generic_types = [substitute(t, subst) for t in ty.generic_types]
-        return DisTy(ty.name, generic_types, ty.pattern)
-    elif isinstance(ty, TyVar):
+    if isinstance(ty, TyVar):
         return subst[ty.index]
-    else:
+    elif not isinstance(ty, (FunTy, DisTy)):
         return ty
+
+    subst = tuple(subst)
+    key = (ty, subst)
+    result = SUBSTITUTIONS.get(key)
+    if result is None:
+        if isinstance(ty, FunTy):
+            arg_types = [substitute(arg, subst) for arg in ty.arg_types]
+            result_type = substitute(ty.result_type, subst)
+            result = FunTy(arg_types, result_type)
+        else:
+            generic_types = [substitute(t, subst) for t in ty.generic_types]
+            result = DisTy(ty.name, generic_types, ty.pattern)
+        SUBSTITUTIONS[key] = result
+    return result
+
+
+class InstantiationCache:
+    '''
+    Types of generic declarations instantiated with given generic arguments.
+    Declarations are keyed by name, so a cache belongs to one typing context,
+    and generic arguments are interned, so equal instantiations share an entry.
+    Worker processes typechecking functions in parallel have caches of their own,
+    so hits and misses count lookups of the parent process only.
+    '''
+    def __init__(self):
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, instantiate):
+        result = self.table.get(key)
+        if result is None:
+            self.misses += 1
+            result = self.table[key] = instantiate()
+        else:
+            self.hits += 1
+        return result
+
+    def function_type(self, name: str, decl: FunctionDeclaration, generics: List[Ty]) -> Ty:
+        return self.get(('fun', name, tuple(generics)), lambda: substitute(decl.ty, generics))
+
+    def variant_arg_types(self, dis_name: str, variant: VariantDeclaration, generics: List[Ty]) -> Tuple[Ty, ...]:
+        return self.get(
+            ('variant', dis_name, variant.name, tuple(generics)),
+            lambda: tuple(substitute(arg.ty, generics) for arg in variant.args))
+
+    def constructor_type(self, dis_name: str, variant: VariantDeclaration, generics: List[Ty]) -> Ty:
+        def instantiate():
+            variant_ty = DisTy(dis_name, generics, TyPattern(variant.name, None))
+            arg_tys = self.variant_arg_types(dis_name, variant, generics)
+            return FunTy(arg_tys, variant_ty) if arg_tys else variant_ty
+        return self.get(('constructor', dis_name, variant.name, tuple(generics)), instantiate)
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f"instantiation cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)"